@@ -0,0 +1,119 @@
+'''
+Headless batch export of the ICU stay PDF reports
+The chart events of the cohort are fetched once, the range analysis is computed once for the whole cohort,
+and every stay is rendered and written on a pool of worker processes, each report includes its plot
+'''
+
+# Imports
+import argparse
+import os
+import time
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from data_sources import BigQuerySource, ParquetSource
+from query_cache import CachedSource
+from result_tables import split_results, concat_events
+from range_analysis import range_table, stay_ranges
+import stay_report
+
+# Same plot settings as the app
+render_settings = {'format': 'png', 'width': 700, 'height': 500}
+
+# Render the plot and write the PDF report of one stay, runs on the worker processes
+def write_report(output_dir, stay, events, header, ranges, max_points=1400, downsample_method='minmax'):
+    image = stay_report.stay_figure(stay, events, header, max_points, downsample_method).to_image(**render_settings)
+    file_path = os.path.join(output_dir, f"stay_{header['subject_id']}_{stay}.pdf")
+    stay_report.write_stay_pdf(file_path, stay, header, stay_report.stay_stats(events), ranges, image)
+    return file_path
+
+# Per stay arguments of write_report, only the rows of the stay are sent to the workers
+def report_jobs(stays, events, ranges):
+    for stay, stay_events in events.groupby('ICUSTAY_ID', sort=False):
+        yield stay, stay_events, stay_report.stay_header(stays.loc[stay]), stay_ranges(ranges, stay)
+
+# Fetch the patients in pages into one stays table and one events table, like the app does
+# Returns None when none of the patients has vital sign events
+def fetch_cohort(source, patients, page_size=50):
+    stays, events = [], []
+    for page_start in range(0, len(patients), page_size):
+        results = source.fetch_data(patients[page_start:page_start + page_size])
+        if results.empty:
+            continue
+        page_stays, page_events = split_results(results)
+        stays.append(page_stays)
+        events.append(page_events)
+        print(f"Fetched {min(page_start + page_size, len(patients))}/{len(patients)} patients")
+    if not events:
+        return None
+    return pd.concat(stays), concat_events(events)
+
+# Write the report of every stay of the patients, at most workers * 4 reports are queued at once
+# The range table is computed once over the whole cohort, so the cohort percentiles match the app
+def run_batch(source, patients, output_dir, workers=None, page_size=50):
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count()
+    done = failed = 0
+    start = time.perf_counter()
+
+    cohort = fetch_cohort(source, patients, page_size)
+    if cohort is None:
+        print("No stays found for these patients")
+        return 0
+    stays, events = cohort
+    ranges = range_table(events)
+    total = len(stays)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        # Wait for at least one report and print the progress
+        def collect(return_when):
+            nonlocal done, failed
+            finished, _ = wait(pending, return_when=return_when)
+            for future in finished:
+                stay = pending.pop(future)
+                try:
+                    future.result()
+                except Exception as error:
+                    failed += 1
+                    print(f"ICU stay {stay} failed: {error}")
+                done += 1
+            elapsed = time.perf_counter() - start
+            print(f"[{done}/{total}] {done / elapsed:.2f} reports/s")
+
+        for stay, stay_events, header, stay_range in report_jobs(stays, events, ranges):
+            while len(pending) >= workers * 4:
+                collect(FIRST_COMPLETED)
+            pending[executor.submit(write_report, output_dir, stay, stay_events, header, stay_range)] = stay
+        while pending:
+            collect(FIRST_COMPLETED)
+
+    elapsed = time.perf_counter() - start
+    print(f"{done - failed} reports written to {output_dir} in {elapsed:.1f} s, {failed} failed")
+    return done - failed
+
+# Patients from the command line, a file with one SUBJECT_ID per line or the cohort of the source
+def read_patients(args, source):
+    if args.patients:
+        return [int(p) for p in args.patients.split(',')]
+    if args.patients_file:
+        with open(args.patients_file) as f:
+            return [int(line) for line in f if line.strip()]
+    return list(source.fetch_subject_ids()['SUBJECT_ID'].unique())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', default='reports', help='Directory of the PDF reports')
+    parser.add_argument('--patients', default=None, help='Comma separated SUBJECT_IDs')
+    parser.add_argument('--patients_file', default=None, help='File with one SUBJECT_ID per line')
+    parser.add_argument('--workers', type=int, default=None, help='Report worker processes, defaults to the number of CPUs')
+    parser.add_argument('--page_size', type=int, default=50, help='Patients fetched per query')
+    parser.add_argument('--data_dir', default=None, help='Directory with Parquet copies of the MIMIC tables, used instead of BigQuery')
+    parser.add_argument('--cache_dir', default=os.path.expanduser('~/.cache/icustay'), help='Directory of the query result cache')
+    parser.add_argument('--no_cache', action='store_true', help='Always query the data source')
+    args = parser.parse_args()
+
+    source = ParquetSource(args.data_dir) if args.data_dir else BigQuerySource()
+    if not args.no_cache:
+        source = CachedSource(source, args.cache_dir)
+    run_batch(source, read_patients(args, source), args.output_dir, args.workers, args.page_size)
@@ -0,0 +1,63 @@
+'''
+DirectRunner benchmark of the per ICUSTAY_ID grouping step of train_test_csv_creation.py
+Compares the old CombinePerKey(sum(values, [])) + SortValues against CollectMeasures
+on synthetic stays of increasing size
+'''
+
+# Imports
+import argparse
+import datetime
+import random
+import time
+import apache_beam as beam
+from apache_beam.options.pipeline_options import PipelineOptions
+from train_test_csv_creation import PrepareData, CollectMeasures
+
+# Synthetic chart events of a single stay, shuffled like a warehouse export
+def synthetic_stay(icustay_id, n_events, seed=0):
+    rng = random.Random(seed)
+    start = datetime.datetime(2100, 1, 1, tzinfo=datetime.timezone.utc)
+    events = []
+    for i in range(n_events):
+        charttime = start + datetime.timedelta(minutes=i)
+        events.append({
+            'ICUSTAY_ID': icustay_id,
+            'ITEMID': rng.choice((211, 220045, 618, 646)),
+            'VALUE': str(rng.randint(40, 140)),
+            'CHARTTIME': charttime.strftime("%Y-%m-%d %H:%M:%S%z"),
+            'LOS': 3.0,
+        })
+    rng.shuffle(events)
+    return events
+
+# Grouping as it was before CollectMeasures
+def group_baseline(pcoll):
+    return (pcoll
+            | 'FormatData' >> beam.Map(lambda element: (element[0], [element[1]]))
+            | 'CombinePerKey' >> beam.CombinePerKey(lambda values: sum(values, []))
+            | 'SortValues' >> beam.Map(lambda kv: (kv[0], sorted(kv[1], key=lambda x: x[2]))))
+
+# Current grouping
+def group_collect(pcoll):
+    return pcoll | 'CollectMeasures' >> beam.CombinePerKey(CollectMeasures())
+
+# Time one pipeline run over the given events
+def time_grouping(events, group):
+    start = time.perf_counter()
+    with beam.Pipeline(options=PipelineOptions(runner='DirectRunner')) as p:
+        (group(p | beam.Create(events) | beam.ParDo(PrepareData()))
+         | beam.Map(lambda kv: len(kv[1])))
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--max_baseline', type=int, default=100000, help='Skip the baseline above this many events')
+    args = parser.parse_args()
+
+    print(f"{'events':>10} {'baseline (s)':>14} {'CollectMeasures (s)':>20}")
+    for n_events in args.sizes:
+        events = synthetic_stay(1, n_events)
+        baseline = f"{time_grouping(events, group_baseline):.2f}" if n_events <= args.max_baseline else 'skipped'
+        collect = time_grouping(events, group_collect)
+        print(f"{n_events:>10} {baseline:>14} {collect:>20.2f}")
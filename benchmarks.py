@@ -0,0 +1,285 @@
+'''
+Benchmark suite on the synthetic tables of synthetic_mimic.py, no BigQuery or GCS access is needed
+pipeline: the PrepareData, CollectMeasures, ConsolidateMeasures, WindowSequences and FormatOutput stages in process,
+plus the whole pipeline on DirectRunner (reported, not gated: its runner start up swamps the stages)
+viewer: the PlotterApp index, per stay lookups, statistics, range analysis, figures and rendering
+features: parsing the csv sequences like the notebooks, extract_features, StayFeatures and the columnar readers
+Every run is appended to a JSON lines file and compared with the previous run of the same benchmark and size
+'''
+
+# Imports
+import argparse
+import ast
+import datetime
+import json
+import os
+import subprocess
+import tempfile
+import time
+import apache_beam as beam
+import numpy as np
+import pandas as pd
+from apache_beam.options.pipeline_options import PipelineOptions
+from synthetic_mimic import generate, pipeline_inputs
+from train_test_csv_creation import (PrepareData, CollectMeasures, ConsolidateMeasures, WindowSequences,
+                                     FormatOutput, FormatColumnar, StayFeatures, SEQUENCE_SCHEMA)
+from data_sources import ParquetSource
+from datav7 import PlotterApp
+from sequence_reader import read_sequences
+from sequence_batches import BatchLoader
+
+# Best of repeat timings of fn, in seconds
+def best_time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+# Chart events of the pipeline inputs as the dicts read from BigQuery or Parquet
+def pipeline_records(tables):
+    events = pipeline_inputs(tables)['chartevents']
+    records = events.to_dict('records')
+    for record, charttime in zip(records, events['CHARTTIME'].dt.to_pydatetime()):
+        record['CHARTTIME'] = charttime
+    return records
+
+# Outputs of a DoFn over a list of elements, run in process like a runner would
+def run_dofn(dofn, elements):
+    dofn.setup()
+    return [output for element in elements for output in dofn.process(element)]
+
+# Measures keyed by ICUSTAY_ID grouped per stay, the grouping done by the runner before CombinePerKey
+def group_measures(keyed):
+    measures = {}
+    for icustay_id, measure in keyed:
+        measures.setdefault(icustay_id, []).append(measure)
+    return measures
+
+# CollectMeasures over the measures of every stay, as CombinePerKey with a single accumulator per stay
+def collect_measures(measures):
+    collect = CollectMeasures()
+    stays = []
+    for icustay_id, group in measures.items():
+        accumulator = collect.create_accumulator()
+        for measure in group:
+            accumulator = collect.add_input(accumulator, measure)
+        stays.append((icustay_id, collect.extract_output(accumulator)))
+    return stays
+
+# Pipeline stages timed in process, every stage runs on the outputs of the previous one
+pipeline_stages = [
+    ('PrepareData', lambda records: run_dofn(PrepareData(), records)),
+    ('CollectMeasures', lambda keyed: collect_measures(group_measures(keyed))),
+    ('ConsolidateMeasures', lambda stays: run_dofn(ConsolidateMeasures(), stays)),
+    ('WindowSequences', lambda stays: run_dofn(WindowSequences(), stays)),
+    ('FormatOutput', lambda stays: run_dofn(FormatOutput(), stays)),
+]
+
+# The whole pipeline on DirectRunner
+def run_direct(records):
+    with beam.Pipeline(options=PipelineOptions([], runner='DirectRunner')) as p:
+        (p
+         | beam.Create(records)
+         | 'PrepareData' >> beam.ParDo(PrepareData())
+         | 'CollectMeasures' >> beam.CombinePerKey(CollectMeasures())
+         | 'ConsolidateMeasures' >> beam.ParDo(ConsolidateMeasures())
+         | 'WindowSequences' >> beam.ParDo(WindowSequences())
+         | 'FormatOutput' >> beam.ParDo(FormatOutput())
+         | 'Count' >> beam.combiners.Count.Globally())
+
+def bench_pipeline(tables, repeat):
+    records = pipeline_records(tables)
+    results = {}
+    elements = records
+    for name, stage in pipeline_stages:
+        results[name] = best_time(lambda: stage(elements), repeat)
+        elements = stage(elements)
+    # The first pipeline of a process pays for the runner start up
+    run_direct(records[:10])
+    results['DirectRunner end to end'] = best_time(lambda: run_direct(records), repeat)
+    return results
+
+# Benchmarks that are stored and compared but never reported as regressions
+ungated = {('pipeline', 'DirectRunner end to end')}
+
+# PlotterApp without a window, only its data structures are built
+def headless_app(results, patients):
+    app = object.__new__(PlotterApp)
+    app.patient_ids = patients
+    app.build_index(results)
+    return app
+
+def bench_viewer(tables, repeat, max_stays=50):
+    with tempfile.TemporaryDirectory() as directory:
+        for name, table in tables.items():
+            table.to_parquet(f'{directory}/{name}.parquet', index=False)
+        source = ParquetSource(directory)
+        patients = list(tables['PATIENTS']['SUBJECT_ID'])
+        results = source.fetch_data(patients)
+
+    app = headless_app(results, patients)
+    stays = list(app.stay_slices)
+    sample = stays[:max_stays]
+
+    def lookups():
+        for stay in stays:
+            app.stay_rows(stay)
+
+    def headers():
+        app.stay_headers = {}
+        for stay in stays:
+            app.stay_header(stay)
+
+    def stats():
+        app.stay_stats_cache = {}
+        for stay in sample:
+            app.stay_stats(stay)
+
+    def ranges():
+        app.cohort_range_table = None
+        app.cohort_ranges()
+
+    def figures():
+        for stay in sample:
+            app.build_figure(stay)
+
+    timings = {
+        'build_index': best_time(lambda: headless_app(results, patients), repeat),
+        f'stay_rows x{len(stays)}': best_time(lookups, repeat),
+        f'stay_header x{len(stays)}': best_time(headers, repeat),
+        f'stay_stats x{len(sample)}': best_time(stats, repeat),
+        'cohort_ranges': best_time(ranges, repeat),
+        f'build_figure x{len(sample)}': best_time(figures, repeat),
+    }
+    # Rendering needs kaleido and Chrome
+    try:
+        app.build_figure(sample[0]).to_image(**PlotterApp.render_settings)
+    except Exception as error:
+        print(f"Skipping render: {str(error).strip().splitlines()[0]}")
+    else:
+        timings[f'render x{min(len(sample), 5)}'] = best_time(
+            lambda: [app.build_figure(stay).to_image(**PlotterApp.render_settings) for stay in sample[:5]], repeat)
+    return timings
+
+# Feature extraction of the RF and CatBoost notebooks, the baseline of StayFeatures
+def extract_features(seq):
+    values = []
+    for item in seq:
+        if isinstance(item, list):
+            values.extend([x[1] for x in item if isinstance(x, tuple) and x[1] is not None])
+        elif isinstance(item, tuple) and item[1] is not None:
+            values.append(item[1])
+    if not values:
+        return pd.Series(dict.fromkeys(['mean', 'std', 'max', 'min', 'length', 'unique', 'variance', 'skewness', 'kurtosis'], 0))
+    return pd.Series({
+        'mean': np.mean(values), 'std': np.std(values), 'max': np.max(values), 'min': np.min(values),
+        'length': len(values), 'unique': len(set(values)), 'variance': np.var(values),
+        'skewness': pd.Series(values).skew(), 'kurtosis': pd.Series(values).kurtosis(),
+    })
+
+def bench_features(tables, repeat):
+    # Stays through the DoFns in process, the stages are timed by the pipeline suite
+    measures = group_measures(run_dofn(PrepareData(), pipeline_records(tables)))
+    stays = run_dofn(ConsolidateMeasures(), collect_measures(measures))
+    csv_sequences = [line.split('"')[1] for line in run_dofn(FormatOutput(), stays)]
+
+    def parse():
+        return [ast.literal_eval(sequence) for sequence in csv_sequences]
+
+    def notebook_features():
+        return [extract_features(seq) for seq in parse()]
+
+    def stay_features():
+        combine = StayFeatures()
+        for group in measures.values():
+            accumulator = combine.create_accumulator()
+            for measure in group:
+                combine.add_input(accumulator, measure)
+            combine.extract_output(accumulator)
+
+    with tempfile.TemporaryDirectory() as directory:
+        rows = run_dofn(FormatColumnar(), stays)
+        pd.DataFrame(rows).to_parquet(f'{directory}/training.parquet', schema=SEQUENCE_SCHEMA, index=False)
+
+        def batches():
+            for _ in BatchLoader(f'{directory}/training', batch_size=64):
+                pass
+
+        return {
+            'literal_eval': best_time(parse, repeat),
+            'extract_features (notebooks)': best_time(notebook_features, repeat),
+            'StayFeatures': best_time(stay_features, repeat),
+            'read_sequences': best_time(lambda: read_sequences(f'{directory}/training'), repeat),
+            'BatchLoader epoch': best_time(batches, repeat),
+        }
+
+suites = {'pipeline': bench_pipeline, 'viewer': bench_viewer, 'features': bench_features}
+
+# Commit of the benchmarked tree, None outside a git checkout
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Stored benchmark results, one JSON object per line
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# Compare the records of a run with the last earlier record of the same benchmark and size
+# Returns the gated records that got slower by more than threshold and by more than min_delta seconds
+def compare(records, history, threshold, min_delta):
+    previous = {}
+    for record in history:
+        previous[(record['suite'], record['benchmark'], record['events'])] = record
+    regressions = []
+    for record in records:
+        before = previous.get((record['suite'], record['benchmark'], record['events']))
+        if before is None or before['seconds'] <= 0:
+            continue
+        change = record['seconds'] / before['seconds'] - 1
+        flag = ''
+        if record.get('gated', True) and change > threshold and record['seconds'] - before['seconds'] > min_delta:
+            flag = '  REGRESSION'
+            regressions.append(record)
+        print(f"{record['suite']:>9} {record['benchmark']:<40} {record['events']:>9} "
+              f"{before['seconds']:>9.3f} -> {record['seconds']:>9.3f} s ({change:+.0%}, run {before['run']}){flag}")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--suites', nargs='+', choices=list(suites), default=list(suites))
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark, the fastest one is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--results', default='benchmark_results.jsonl', help='File the results are appended to')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Slowdown reported as a regression')
+    parser.add_argument('--min_delta', type=float, default=0.05, help='Slowdowns of fewer seconds are timing noise')
+    args = parser.parse_args()
+
+    run = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%d%H%M%S')
+    commit = current_commit()
+    history = load_results(args.results)
+    records = []
+    for n_events in args.events:
+        tables = generate(n_events, args.seed)
+        for suite in args.suites:
+            for benchmark, seconds in suites[suite](tables, args.repeat).items():
+                records.append({'run': run, 'commit': commit, 'suite': suite, 'benchmark': benchmark, 'events': n_events,
+                                'seconds': seconds, 'events_per_s': n_events / seconds if seconds > 0 else None,
+                                'gated': (suite, benchmark) not in ungated})
+                print(f"{suite:>9} {benchmark:<40} {n_events:>9} {seconds:>9.3f} s")
+
+    with open(args.results, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    if history:
+        print(f"\nCompared with earlier runs in {args.results}:")
+        regressions = compare(records, history, args.threshold, args.min_delta)
+        if regressions:
+            raise SystemExit(f"{len(regressions)} benchmarks are more than {args.threshold:.0%} slower")
@@ -0,0 +1,135 @@
+'''
+Data sources of the ICU data visualization app
+BigQuerySource runs the queries against the MIMIC tables in BigQuery,
+ParquetSource answers the same requests from local Parquet copies of the tables
+Both return DataFrames with the same columns and order
+'''
+
+# Imports
+import pandas as pd
+from vital_items import item_ids
+from span_timer import span
+
+# Columns returned by fetch_data, in order
+DATA_COLUMNS = ['SUBJECT_ID', 'ICUSTAY_ID', 'ITEMID', 'LABEL', 'VALUE', 'VALUEUOM', 'CHARTTIME', 'LOS', 'DIAGNOSIS', 'GENDER', 'DOB', 'ADMITTIME']
+
+# SQL list of IDs, tuple() would give an invalid "(123,)" for a single ID
+def sql_list(ids):
+    return "(" + ", ".join(str(int(i)) for i in ids) + ")"
+
+# MIMIC tables in BigQuery
+class BigQuerySource:
+    def __init__(self, project='cdla-trabalho', dataset='CHARTEVENTS'):
+        from google.cloud import bigquery
+
+        # Initialize a BigQuery client
+        self.client = bigquery.Client()
+        self.tables = f'{project}.{dataset}'
+
+    # Query of the chart events, patients is the SQL list of SUBJECT_IDs
+    def data_query(self, patients):
+        return f"""
+            SELECT
+                t1.SUBJECT_ID,
+                t2.ICUSTAY_ID,
+                t1.ITEMID,
+                t3.LABEL,
+                t1.VALUE,
+                t1.VALUEUOM,
+                t1.CHARTTIME,
+                t2.LOS,
+                t4.DIAGNOSIS,
+                t5.GENDER,
+                t5.DOB,
+                t6.ADMITTIME
+            FROM
+                `{self.tables}.CHARTEVENTS` AS t1
+            INNER JOIN
+                `{self.tables}.ICUSTAYS` AS t2
+            ON
+                t1.ICUSTAY_ID = t2.ICUSTAY_ID
+            INNER JOIN
+                `{self.tables}.D_ITEMS` AS t3
+            ON
+                t1.ITEMID = t3.ITEMID
+            LEFT JOIN
+                `{self.tables}.ADMISSIONS` AS t4
+            ON
+                t2.HADM_ID = t4.HADM_ID
+            INNER JOIN
+                `{self.tables}.PATIENTS` AS t5
+            ON
+                t1.SUBJECT_ID = t5.SUBJECT_ID
+            LEFT JOIN
+                `{self.tables}.ADMISSIONS` AS t6
+            ON
+                t2.HADM_ID = t6.HADM_ID
+            WHERE 
+                t1.SUBJECT_ID IN {patients}
+                AND t1.ERROR = 0  
+                AND t1.ITEMID IN {sql_list(item_ids)}
+            ORDER BY t2.ICUSTAY_ID, t1.CHARTTIME ASC 
+        """
+
+    # Identifies the results of fetch_data for the query cache: the normalized query without the patients
+    def cache_key(self):
+        return " ".join(self.data_query("?").split())
+
+    # Chart events of the given patients
+    def fetch_data(self, patients):
+        query = self.data_query(sql_list(patients))
+        print("SQL Query:", query)  # Print the SQL query for verification and debugging
+
+        with span('query'):
+            query_job = self.client.query(query)
+            results = query_job.result()
+
+        with span('to_dataframe'):
+            return results.to_dataframe()
+
+    # A certain amount of distinct SUBJECT_IDs
+    def fetch_subject_ids(self, limit=200):
+        query = f"""
+            SELECT DISTINCT t1.SUBJECT_ID, t2.ICUSTAY_ID
+            FROM `{self.tables}.CHARTEVENTS` AS t1
+            INNER JOIN `{self.tables}.ICUSTAYS` AS t2
+            ON t1.SUBJECT_ID = t2.SUBJECT_ID
+            WHERE RAND() < 0.01  -- Adjusted the sampling fraction
+            ORDER BY RAND()
+            LIMIT {int(limit)}
+        """
+        query_job = self.client.query(query)
+        results = query_job.result()
+
+        return results.to_dataframe()
+
+# Local stand-in of the MIMIC tables: CHARTEVENTS, ICUSTAYS, D_ITEMS, ADMISSIONS and PATIENTS .parquet files in a directory
+class ParquetSource:
+    def __init__(self, directory, seed=0):
+        self.directory = directory
+        self.seed = seed
+
+    # Identifies the results of fetch_data for the query cache
+    def cache_key(self):
+        return f"parquet:{self.directory}:{DATA_COLUMNS}:{item_ids}"
+
+    def read(self, table, columns, filters=None):
+        with span(f'read {table}'):
+            return pd.read_parquet(f'{self.directory}/{table}.parquet', columns=columns, filters=filters)
+
+    # Same rows as the BigQuery join, CHARTEVENTS is filtered while it is read
+    def fetch_data(self, patients):
+        events = self.read('CHARTEVENTS', ['SUBJECT_ID', 'ICUSTAY_ID', 'ITEMID', 'VALUE', 'VALUEUOM', 'CHARTTIME', 'ERROR'],
+                           filters=[('SUBJECT_ID', 'in', [int(p) for p in patients]), ('ITEMID', 'in', list(item_ids)), ('ERROR', '=', 0)])
+        results = (events
+                   .merge(self.read('ICUSTAYS', ['ICUSTAY_ID', 'HADM_ID', 'LOS']), on='ICUSTAY_ID')
+                   .merge(self.read('D_ITEMS', ['ITEMID', 'LABEL']), on='ITEMID')
+                   .merge(self.read('ADMISSIONS', ['HADM_ID', 'DIAGNOSIS', 'ADMITTIME']), on='HADM_ID', how='left')
+                   .merge(self.read('PATIENTS', ['SUBJECT_ID', 'GENDER', 'DOB']), on='SUBJECT_ID'))
+        results = results.sort_values(['ICUSTAY_ID', 'CHARTTIME'], kind='stable').reset_index(drop=True)
+        return results[DATA_COLUMNS]
+
+    # A reproducible sample of distinct SUBJECT_IDs with their stays
+    def fetch_subject_ids(self, limit=200):
+        stays = self.read('ICUSTAYS', ['SUBJECT_ID', 'ICUSTAY_ID']).drop_duplicates()
+        return stays.sample(n=min(limit, len(stays)), random_state=self.seed).reset_index(drop=True)
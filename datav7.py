@@ -6,100 +6,86 @@ More detailed explanations are made on the report
 '''
 
 # Imports
+import argparse
 import asyncio
+import os
+import queue
+import threading
+import time
+import numpy as np
 import pandas as pd
-from google.cloud import bigquery
-import plotly.graph_objs as go
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-from fpdf import FPDF
 from datetime import datetime
-
-# Initialize a BigQuery client
-client = bigquery.Client()
-
-# Define the ITEMIDs for the desired attributes (Heart Rate, O2 Percentage, Respiration Rate, etc.) 
-item_ids = (211, 220045, 51, 220179, 8368, 220180, 52, 220181, 618, 220210, 646, 220277, 678, 223761, 113, 220074, 807, 220621, 40055)
-
-# Define the SQL query
-async def fetch_data(patients):
-    query = f"""
-        SELECT
-            t1.SUBJECT_ID,
-            t2.ICUSTAY_ID,
-            t3.LABEL,
-            t1.VALUE,
-            t1.VALUEUOM,
-            t1.CHARTTIME,
-            t2.LOS,
-            t4.DIAGNOSIS,
-            t5.GENDER,
-            t5.DOB,
-            t6.ADMITTIME
-        FROM
-            `cdla-trabalho.CHARTEVENTS.CHARTEVENTS` AS t1
-        INNER JOIN
-            `cdla-trabalho.CHARTEVENTS.ICUSTAYS` AS t2
-        ON
-            t1.ICUSTAY_ID = t2.ICUSTAY_ID
-        INNER JOIN
-            `cdla-trabalho.CHARTEVENTS.D_ITEMS` AS t3
-        ON
-            t1.ITEMID = t3.ITEMID
-        LEFT JOIN
-            `cdla-trabalho.CHARTEVENTS.ADMISSIONS` AS t4
-        ON
-            t2.HADM_ID = t4.HADM_ID
-        INNER JOIN
-            `cdla-trabalho.CHARTEVENTS.PATIENTS` AS t5
-        ON
-            t1.SUBJECT_ID = t5.SUBJECT_ID
-        LEFT JOIN
-            `cdla-trabalho.CHARTEVENTS.ADMISSIONS` AS t6
-        ON
-            t2.HADM_ID = t6.HADM_ID
-        WHERE 
-            t1.SUBJECT_ID IN {tuple(patients)}
-            AND t1.ERROR = 0  
-            AND t1.ITEMID IN {item_ids}
-        ORDER BY t2.ICUSTAY_ID, t1.CHARTTIME ASC 
-    """
-    print("SQL Query:", query)  # Print the SQL query for verification and debugging
-
-    query_job = client.query(query)
-    results = query_job.result()
-
-    return results.to_dataframe()
-
-
-# Define a query to fetch a certain amount of distinct SUBJECT_IDs
-async def fetch_subject_ids():
-    query = """
-        SELECT DISTINCT t1.SUBJECT_ID, t2.ICUSTAY_ID
-        FROM `cdla-trabalho.CHARTEVENTS.CHARTEVENTS` AS t1
-        INNER JOIN `cdla-trabalho.CHARTEVENTS.ICUSTAYS` AS t2
-        ON t1.SUBJECT_ID = t2.SUBJECT_ID
-        WHERE RAND() < 0.01  -- Adjusted the sampling fraction
-        ORDER BY RAND()
-        LIMIT 200
-    """
-    query_job = client.query(query)
-    results = query_job.result()
-
-    return results.to_dataframe()
+from concurrent.futures import ThreadPoolExecutor
+from data_sources import BigQuerySource, ParquetSource
+from query_cache import CachedSource
+from plot_cache import PlotCache
+from result_tables import split_results, concat_events, charttimes
+from range_analysis import range_table, stay_ranges, range_lines
+import stay_report
+from span_timer import span, record
+
+# Fetch the chart events of the patients without blocking the event loop
+async def fetch_data(source, patients):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, source.fetch_data, patients)
+
+# Fetch a certain amount of distinct SUBJECT_IDs without blocking the event loop
+async def fetch_subject_ids(source):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, source.fetch_subject_ids)
+
+# Fetch the patients in pages, at most max_in_flight pages are queried at once
+# Every page is handed to on_page as (results, patients) as soon as it arrives
+async def load_pages(source, patients, on_page, page_size=20, max_in_flight=4):
+    semaphore = asyncio.Semaphore(max_in_flight)
+
+    # A page that fails to load is reported and skipped, the other pages keep loading
+    async def load(page):
+        async with semaphore:
+            try:
+                return await fetch_data(source, page), page
+            except Exception as error:
+                print(f"Failed to load {len(page)} patients ({page[0]} to {page[-1]}): {error!r}")
+                return None
+
+    pages = [patients[i:i + page_size] for i in range(0, len(patients), page_size)]
+    for loaded in asyncio.as_completed([load(page) for page in pages]):
+        page = await loaded
+        if page is not None:
+            on_page(page)
 
 # Create the app to visualize the data and analysis
 class PlotterApp:
-    def __init__(self, root, results, patients):
+    # Settings passed to kaleido, part of the plot cache key
+    render_settings = {'format': 'png', 'width': 700, 'height': 500}
+    # Point budget of every plotted series (two points per horizontal pixel) and downsampling method
+    max_points = 1400
+    downsample_method = 'minmax'
+
+    def __init__(self, root, results, patients, cache_mb=64, prefetch_workers=2, predictor=None):
         self.root = root
-        self.results = results
-        print(self.results)  # Print the entire dataframe for verification and debugging
+        self.predictor = predictor  # los_service.LOSPredictor, the Resume window shows its prediction
+        print(results)  # Print the entire dataframe for verification and debugging
         self.patient_ids = patients
         print(f"Patient IDs: {self.patient_ids}")  # Debugging
+        self.build_index(results)
         self.current_patient_index = 0
         self.update_stays_for_current_patient()
 
+        # Pages of patients loaded in the background, polled from the Tk thread
+        self.page_queue = queue.Queue()
+
+        # Rendered plots are cached and the adjacent stays are rendered in the background
+        self.plot_cache = PlotCache(cache_mb * 1024 * 1024)
+        self.render_executor = ThreadPoolExecutor(max_workers=prefetch_workers)
+        self.pending_renders = {}
+        self.displayed_stay = None
+
         self.root.title("ICU Data Plotter")
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+        self.root.after(100, self.poll_pages)
 
         self.top_frame = tk.Frame(self.root)
         self.top_frame.pack(side=tk.TOP, fill=tk.X)
@@ -151,15 +137,97 @@ class PlotterApp:
 
         self.plot_stay()
 
+    # Index the results once: ICUSTAY_ID -> row slice, SUBJECT_ID -> stays and patient ID -> position
+    def build_index(self, results):
+        patients = self.patient_ids
+        self.stay_table = None
+        self.events = None
+        self.patient_ids = []
+        self.patient_positions = {}
+        self.stay_slices = {}
+        self.patient_stays = {}
+        self.stay_headers = {}
+        self.stay_stats_cache = {}
+        self.cohort_range_table = None
+        self.add_results(results, patients)
+
+    # Append the results of a page of patients and index them
+    # Pages hold whole patients, so a stay never spans two pages
+    def add_results(self, results, patients):
+        # The wide rows are split into a stays table and a slim events table, VALUE is parsed once
+        with span('split_results'):
+            stays, events = split_results(results)
+        # None of the patients has vital sign events, nothing to index
+        if len(events) == 0:
+            return
+
+        offset = 0 if self.events is None else len(self.events)
+        icustay_ids = events['ICUSTAY_ID'].to_numpy()
+        starts = np.flatnonzero(np.r_[True, icustay_ids[1:] != icustay_ids[:-1]])
+        ends = np.r_[starts[1:], len(icustay_ids)]
+
+        for stay, start, end in zip(icustay_ids[starts].tolist(), starts + offset, ends + offset):
+            self.stay_slices[stay] = slice(start, end)
+            self.patient_stays.setdefault(stays.at[stay, 'SUBJECT_ID'], []).append(stay)
+        if self.events is None:
+            self.stay_table, self.events = stays, events
+        else:
+            self.stay_table = pd.concat([self.stay_table, stays])
+            self.events = concat_events([self.events, events])
+        # The cohort changed, the range table is recomputed on its next use
+        self.cohort_range_table = None
+
+        # Patients without stays are skipped once here instead of on every navigation
+        for pid in patients:
+            if pid in self.patient_stays and pid not in self.patient_positions:
+                self.patient_positions[pid] = len(self.patient_ids)
+                self.patient_ids.append(pid)
+
+    # Add the pages loaded in the background
+    # Polling is rescheduled even if a page fails to be added, so the later pages are not dropped
+    def poll_pages(self):
+        try:
+            while True:
+                try:
+                    results, patients = self.page_queue.get_nowait()
+                except queue.Empty:
+                    break
+                self.add_results(results, patients)
+                print(f"Loaded {len(patients)} more patients, {len(self.patient_ids)} patients with stays")  # Debugging
+                if len(self.stays) == 0 and self.patient_ids:
+                    self.update_stays_for_current_patient()
+                    self.plot_stay()
+        finally:
+            self.root.after(100, self.poll_pages)
+
+    # Events of an ICU stay
+    def stay_rows(self, stay):
+        with span('stay_rows'):
+            return self.events.iloc[self.stay_slices[stay]]
+
+    # Header fields of an ICU stay, computed once per stay
+    def stay_header(self, stay):
+        if stay not in self.stay_headers:
+            self.stay_headers[stay] = stay_report.stay_header(self.stay_table.loc[stay])
+        return self.stay_headers[stay]
+
+    # Vital sign statistics of an ICU stay, computed once per stay
+    def stay_stats(self, stay):
+        if stay not in self.stay_stats_cache:
+            with span('stay_stats'):
+                self.stay_stats_cache[stay] = stay_report.stay_stats(self.stay_rows(stay))
+        return self.stay_stats_cache[stay]
+
+    # Time-in-range statistics of every stay of the loaded cohort, computed in one pass and reused until pages are added
+    def cohort_ranges(self):
+        if self.cohort_range_table is None:
+            with span('range_table'):
+                self.cohort_range_table = range_table(self.events)
+        return self.cohort_range_table
+
     # Show some examples of patients with stays in case of a search for invalid ID
     def print_patients_with_stays(self):
-        patients_with_stays = []
-        for patient_id in self.patient_ids:
-            stays = self.results[self.results['SUBJECT_ID'] == patient_id]['ICUSTAY_ID'].unique()
-            if len(stays) > 0:
-                patients_with_stays.append(patient_id)
-            if len(patients_with_stays) >= 10:
-                break
+        patients_with_stays = self.patient_ids[:10]
         print(f"Patients with stays: {patients_with_stays}")
         messagebox.showinfo("Patients with stays", f"Patients with stays: {patients_with_stays}")
 
@@ -174,12 +242,12 @@ class PlotterApp:
             return
 
         print(f"Searching for patient ID: {pid}")  # Debugging
-        if pid not in self.patient_ids:
+        if pid not in self.patient_positions:
             messagebox.showerror("Invalid ID", "The patient ID is not found. Please try again.")
             self.print_patients_with_stays()  # Print patients with stays if the patient ID is not found
             return
 
-        self.current_patient_index = self.patient_ids.index(pid)
+        self.current_patient_index = self.patient_positions[pid]
         self.update_stays_for_current_patient()
         self.plot_stay()
 
@@ -203,65 +271,108 @@ class PlotterApp:
         else:
             messagebox.showinfo("Info", "This is the last patient.")
 
-    # In case of a patient with no stays, skip
+    # Load the stays of the current patient, patients without stays were already skipped by build_index
     def update_stays_for_current_patient(self):
-        while True:
-            if self.current_patient_index >= len(self.patient_ids):
-                messagebox.showinfo("Info", "No more patients with stays found.")
-                self.current_patient_index = 0
-                return
-            current_patient = self.patient_ids[self.current_patient_index]
-            print(f"Current patient ID: {current_patient}")  # Debugging
-            self.stays = self.results[self.results['SUBJECT_ID'] == current_patient]['ICUSTAY_ID'].unique()
-            print(f"Stays for current patient: {self.stays}")  # Debugging
-            if len(self.stays) > 0:
-                break
-            else:
-                print(f"No stays found for patient {current_patient}. Removing patient.")
-                self.patient_ids.pop(self.current_patient_index)
-                if self.current_patient_index >= len(self.patient_ids):
-                    messagebox.showinfo("Info", "No more patients with stays found.")
-                    self.current_patient_index = 0
-                    return
-
+        if self.current_patient_index >= len(self.patient_ids):
+            messagebox.showinfo("Info", "No more patients with stays found.")
+            self.current_patient_index = 0
+            self.stays = []
+            return
+        current_patient = self.patient_ids[self.current_patient_index]
+        print(f"Current patient ID: {current_patient}")  # Debugging
+        self.stays = self.patient_stays[current_patient]
+        print(f"Stays for current patient: {self.stays}")  # Debugging
         self.current_stay_index = 0
 
-    # Plotting of the ICU stay
+    # Plotting of the ICU stay, cached images are shown at once and the others are rendered off the Tk thread
     def plot_stay(self):
         if not hasattr(self, 'stays') or len(self.stays) == 0:
             messagebox.showerror("Error", "No stays found for this patient.")
             return
 
+        started = time.perf_counter()
         stay = self.stays[self.current_stay_index]
-        stay_results = self.results[self.results['ICUSTAY_ID'] == stay]
-        diagnosis = stay_results['DIAGNOSIS'].iloc[0] if 'DIAGNOSIS' in stay_results.columns else "No diagnosis info"
-
-        fig = go.Figure()
-        grouped_stay_results = stay_results.groupby('LABEL')
-
-        for label, stay_values in grouped_stay_results:
-            x = pd.to_datetime(stay_values['CHARTTIME'])
-            y = stay_values['VALUE']
-            fig.add_trace(go.Scatter(x=x, y=y, mode='lines', name=label))
-
-        fig.update_layout(
-            title=f'Subject ID: {stay_results["SUBJECT_ID"].iloc[0]}, ICU Stay ID: {stay}<br>Diagnosis: {diagnosis}',
-            xaxis_title='Time',
-            yaxis_title='Value'
-        )
+        self.displayed_stay = stay
+        image = self.plot_cache.get(self.plot_key(stay))
+        if image is not None:
+            self.show_plot(image)
+            record('plot_stay cached', (time.perf_counter() - started) * 1000)
+        else:
+            self.show_rendering()
+            self.wait_for_render(stay, self.submit_render(stay), started)
+        self.prefetch_adjacent()
+
+    # Cache key of the plot of a stay
+    def plot_key(self, stay):
+        return (stay, tuple(sorted(self.render_settings.items())), self.max_points, self.downsample_method)
+
+    # Build the figure of an ICU stay
+    def build_figure(self, stay):
+        with span('build_figure'):
+            return stay_report.stay_figure(stay, self.stay_rows(stay), self.stay_header(stay), self.max_points, self.downsample_method)
+
+    # Render the plot of a stay through kaleido, runs on the worker threads
+    def render_stay(self, stay):
+        key = self.plot_key(stay)
+        image = self.plot_cache.get(key)
+        if image is None:
+            figure = self.build_figure(stay)
+            with span('render'):
+                image = figure.to_image(**self.render_settings)
+            self.plot_cache.put(key, image)
+        return image
+
+    # Submit the render of a stay, a render already in flight is reused
+    def submit_render(self, stay):
+        self.pending_renders = {s: f for s, f in self.pending_renders.items() if not f.done()}
+        if stay not in self.pending_renders:
+            self.pending_renders[stay] = self.render_executor.submit(self.render_stay, stay)
+        return self.pending_renders[stay]
+
+    # Poll a render from the Tk thread and show it if its stay is still the displayed one
+    # started is when the stay was selected, the wait until its plot is shown is timed as 'plot_stay rendered'
+    def wait_for_render(self, stay, future, started=None):
+        if not future.done():
+            self.root.after(30, self.wait_for_render, stay, future, started)
+        elif stay == self.displayed_stay:
+            self.show_plot(future.result())
+            if started is not None:
+                record('plot_stay rendered', (time.perf_counter() - started) * 1000)
+
+    # Prefetch the next and previous stay and the first stay of the next and previous patient
+    def prefetch_adjacent(self):
+        adjacent = []
+        for index in (self.current_stay_index + 1, self.current_stay_index - 1):
+            if 0 <= index < len(self.stays):
+                adjacent.append(self.stays[index])
+        for index in (self.current_patient_index + 1, self.current_patient_index - 1):
+            if 0 <= index < len(self.patient_ids):
+                adjacent.append(self.patient_stays[self.patient_ids[index]][0])
+        for stay in adjacent:
+            if self.plot_key(stay) not in self.plot_cache:
+                self.submit_render(stay)
+
+    # Placeholder while the plot of the stay is rendered
+    def show_rendering(self):
+        for widget in self.plot_frame.winfo_children():
+            widget.destroy()
+        tk.Label(self.plot_frame, text="Rendering plot...").pack()
 
-        self.show_plot(fig)
+    # Stop the render workers when the window is closed
+    def close(self):
+        self.render_executor.shutdown(wait=False, cancel_futures=True)
+        self.root.destroy()
 
     # Display plot
-    def show_plot(self, fig):
+    def show_plot(self, canvas):
         for widget in self.plot_frame.winfo_children():
             widget.destroy()
 
-        canvas = fig.to_image(format="png")
-        image = tk.PhotoImage(data=canvas)
-        label = tk.Label(self.plot_frame, image=image)
-        label.image = image
-        label.pack()
+        with span('show_plot'):
+            image = tk.PhotoImage(data=canvas)
+            label = tk.Label(self.plot_frame, image=image)
+            label.image = image
+            label.pack()
 
     # Previous stay button
     def prev_stay(self):
@@ -282,56 +393,53 @@ class PlotterApp:
     # Show a resume of the stay
     def show_resume(self):
         stay = self.stays[self.current_stay_index]
-        stay_results = self.results[self.results['ICUSTAY_ID'] == stay]
-        diagnosis = stay_results['DIAGNOSIS'].iloc[0] if 'DIAGNOSIS' in stay_results.columns else "No diagnosis info"
-
-        dob = pd.to_datetime(stay_results['DOB'].iloc[0])
-        admit_time = pd.to_datetime(stay_results['ADMITTIME'].iloc[0])
-        age = (admit_time - dob).days // 365
+        header = self.stay_header(stay)
 
         resume_window = tk.Toplevel(self.root)
         resume_window.title("Patient ICU Stay Summary")
 
-        ttk.Label(resume_window, text=f"Subject ID: {stay_results['SUBJECT_ID'].iloc[0]}").pack(pady=10)
+        ttk.Label(resume_window, text=f"Subject ID: {header['subject_id']}").pack(pady=10)
         ttk.Label(resume_window, text=f"ICU Stay ID: {stay}").pack(pady=10)
-        ttk.Label(resume_window, text=f"Diagnosis: {diagnosis}").pack(pady=10)
-        ttk.Label(resume_window, text=f"Length of Stay (LOS): {stay_results['LOS'].iloc[0]:.2f} days").pack(pady=10)
-        ttk.Label(resume_window, text=f"Gender: {stay_results['GENDER'].iloc[0]}").pack(pady=10)
-        ttk.Label(resume_window, text=f"Age: {age} years").pack(pady=10)
-
-        stats = stay_results.groupby('LABEL')['VALUE'].agg(['mean', 'median', 'std', 'min', 'max'])
+        ttk.Label(resume_window, text=f"Diagnosis: {header['diagnosis']}").pack(pady=10)
+        ttk.Label(resume_window, text=f"Length of Stay (LOS): {header['los']:.2f} days").pack(pady=10)
+        ttk.Label(resume_window, text=f"Gender: {header['gender']}").pack(pady=10)
+        ttk.Label(resume_window, text=f"Age: {header['age']} years").pack(pady=10)
+        if self.predictor is not None:
+            prediction_label = ttk.Label(resume_window, text="Predicted LOS: ...")
+            prediction_label.pack(pady=10)
+            self.wait_for_prediction(prediction_label, self.predict_stay(stay))
+
+        stats = self.stay_stats(stay)
         ttk.Label(resume_window, text="Vital Sign Statistics:").pack(pady=10)
         for label, row in stats.iterrows():
-            text = f"{label} - Mean: {row['mean']:.2f}, Median: {row['median']:.2f}, Std: {row['std']:.2f}, Min: {row['min']:.2f}, Max: {row['max']:.2f}"
-            ttk.Label(resume_window, text=text).pack(pady=2)
+            ttk.Label(resume_window, text=stay_report.stats_line(label, row)).pack(pady=2)
+
+    # Submit the events of a stay to the LOS predictor, repeated requests are answered from its cache
+    def predict_stay(self, stay):
+        stay_results = self.stay_rows(stay)
+        events = {'CHARTTIME': charttimes(stay_results), 'ITEMID': stay_results['ITEMID'], 'VALUE': stay_results['VALUE']}
+        return self.predictor.predict(stay, events)
+
+    # Poll a prediction from the Tk thread and show it while its window is open
+    def wait_for_prediction(self, label, future):
+        if not future.done():
+            self.root.after(30, self.wait_for_prediction, label, future)
+        elif label.winfo_exists():
+            if future.exception() is not None:
+                label.config(text=f"Predicted LOS: unavailable ({future.exception()})")
+            else:
+                label.config(text=f"Predicted LOS: {future.result():.2f} days")
 
     # Show a comparative analysis between values of the stay and standard values
     def show_comparative_analysis(self):
         stay = self.stays[self.current_stay_index]
-        stay_results = self.results[self.results['ICUSTAY_ID'] == stay]
 
         comparison_window = tk.Toplevel(self.root)
         comparison_window.title("Comparative Analysis")
 
-        normal_ranges = {
-            "Heart Rate": (60, 100),
-            "O2 saturation pulseoxymetry": (95, 100),
-            "Temperature Fahrenheit": (96.9, 98.9),
-            "Non Invasive Blood Pressure systolic": (90, 120),
-            "Non Invasive Blood Pressure diastolic": (60, 80),
-            "Respiratory Rate": (12, 20),
-            "Glucose (serum)": (70, 140)
-        }
-
-        grouped_stay_results = stay_results.groupby('LABEL')
-
         ttk.Label(comparison_window, text="Comparative Analysis with Normal Ranges:").pack(pady=10)
-        for label, stay_values in grouped_stay_results:
-            if label in normal_ranges:
-                mean_value = stay_values['VALUE'].mean()
-                normal_range = normal_ranges[label]
-                text = f"{label} - Mean: {mean_value:.2f} (Normal Range: {normal_range[0]} - {normal_range[1]})"
-                ttk.Label(comparison_window, text=text).pack(pady=2)
+        for text in range_lines(stay_ranges(self.cohort_ranges(), stay)):
+            ttk.Label(comparison_window, text=text).pack(pady=2)
 
     # Export as PDF button
     def export_as_pdf(self):
@@ -339,68 +447,90 @@ class PlotterApp:
         if not file_path:
             return
 
+        # The report is written on the render workers, the Tk thread only polls it
         stay = self.stays[self.current_stay_index]
-        stay_results = self.results[self.results['ICUSTAY_ID'] == stay]
-        diagnosis = stay_results['DIAGNOSIS'].iloc[0] if 'DIAGNOSIS' in stay_results.columns else "No diagnosis info"
-
-        dob = pd.to_datetime(stay_results['DOB'].iloc[0])
-        admit_time = pd.to_datetime(stay_results['ADMITTIME'].iloc[0])
-        age = (admit_time - dob).days // 365
-
-        stats = stay_results.groupby('LABEL')['VALUE'].agg(['mean', 'median', 'std', 'min', 'max'])
-
-        pdf = FPDF()
-        pdf.add_page()
-        pdf.set_font("Arial", size=12)
-        pdf.cell(200, 10, txt="Patient ICU Stay Summary", ln=True, align='C')
-        pdf.ln(10)
-        pdf.cell(200, 10, txt=f"Subject ID: {stay_results['SUBJECT_ID'].iloc[0]}", ln=True)
-        pdf.cell(200, 10, txt=f"ICU Stay ID: {stay}", ln=True)
-        pdf.cell(200, 10, txt=f"Diagnosis: {diagnosis}", ln=True)
-        pdf.cell(200, 10, txt=f"Length of Stay (LOS): {stay_results['LOS'].iloc[0]:.2f} days", ln=True)
-        pdf.cell(200, 10, txt=f"Gender: {stay_results['GENDER'].iloc[0]}", ln=True)
-        pdf.cell(200, 10, txt=f"Age: {age} years", ln=True)
-        pdf.ln(10)
-        pdf.cell(200, 10, txt="Vital Sign Statistics:", ln=True)
-        for label, row in stats.iterrows():
-            text = f"{label} - Mean: {row['mean']:.2f}, Median: {row['median']:.2f}, Std: {row['std']:.2f}, Min: {row['min']:.2f}, Max: {row['max']:.2f}"
-            pdf.cell(200, 10, txt=text, ln=True)
-        pdf.ln(10)
-        pdf.cell(200, 10, txt="Comparative Analysis with Normal Ranges:", ln=True)
-
-        grouped_stay_results = stay_results.groupby('LABEL')
-        normal_ranges = {
-            "Heart Rate": (60, 100),
-            "SpO2": (95, 100),
-            "Temperature": (36.1, 37.2),
-            "Systolic Blood Pressure": (90, 120),
-            "Diastolic Blood Pressure": (60, 80),
-            "Respiratory Rate": (12, 20),
-            "Glucose": (70, 140)
-        }
-
-        for label, stay_values in grouped_stay_results:
-            if label in normal_ranges:
-                mean_value = stay_values['VALUE'].mean()
-                normal_range = normal_ranges[label]
-                text = f"{label} - Mean: {mean_value:.2f} (Normal Range: {normal_range[0]} - {normal_range[1]})"
-                pdf.cell(200, 10, txt=text, ln=True)
-
-        pdf.output(file_path)
+        future = self.render_executor.submit(self.export_stay, file_path, stay, self.stay_header(stay), self.stay_stats(stay),
+                                             self.events, self.cohort_range_table)
+        self.wait_for_export(file_path, future)
+
+    # Write the PDF report of a stay with its plot, runs on the render workers
+    # A missing range table is computed from the events it was requested with and not cached, pages may have arrived since
+    # If the plot cannot be rendered (kaleido needs Chrome) the report is written without it and the error is returned
+    def export_stay(self, file_path, stay, header, stats, events, table):
+        if table is None:
+            with span('range_table'):
+                table = range_table(events)
+        try:
+            image, render_error = self.render_stay(stay), None
+        except Exception as error:
+            image, render_error = None, error
+        with span('export_pdf'):
+            stay_report.write_stay_pdf(file_path, stay, header, stats, stay_ranges(table, stay), image)
+        return render_error
+
+    # Poll an export from the Tk thread and report how it went
+    def wait_for_export(self, file_path, future):
+        if not future.done():
+            self.root.after(30, self.wait_for_export, file_path, future)
+            return
+        try:
+            render_error = future.result()
+        except Exception as error:
+            messagebox.showerror("Error", f"Could not export {file_path}: {error}")
+            return
+        if render_error is not None:
+            messagebox.showwarning("Warning", f"Exported {file_path} without the plot: {render_error}")
 
 # Main
-async def main():
-    patients = await fetch_subject_ids()
+async def main(source, page_size=20, max_in_flight=4, predictor=None):
+    patients = await fetch_subject_ids(source)
     print(patients.head(100))
     patients = list(patients['SUBJECT_ID'].unique())
     print(patients)
-    results = await fetch_data(patients)
-    print(results.head())  # Debugging print
 
+    # The window opens with the first patient that has stays, the other pages stream in while it is used
+    # Patients are fetched one first, then a page at a time, until a page has vital sign events
+    loaded = 0
+    while True:
+        if loaded >= len(patients):
+            print("No patients with stays found")
+            return
+        page = patients[loaded:loaded + (page_size if loaded else 1)]
+        loaded += len(page)
+        try:
+            results = await fetch_data(source, page)
+        except Exception as error:
+            print(f"Failed to load {len(page)} patients ({page[0]} to {page[-1]}): {error!r}")
+            continue
+        if len(results):
+            break
+    print(results.head())  # Debugging print
 
     root = tk.Tk()
-    app = PlotterApp(root, results, patients)
+    app = PlotterApp(root, results, page, predictor=predictor)
+    loader = threading.Thread(target=lambda: asyncio.run(load_pages(source, patients[loaded:], app.page_queue.put, page_size, max_in_flight)), daemon=True)
+    loader.start()
     root.mainloop()
 
 # Run the application
-asyncio.run(main())
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', default=None, help='Directory with Parquet copies of the MIMIC tables, used instead of BigQuery')
+    parser.add_argument('--page_size', type=int, default=20, help='Patients fetched per query')
+    parser.add_argument('--max_in_flight', type=int, default=4, help='Pages fetched at the same time')
+    parser.add_argument('--cache_dir', default=os.path.expanduser('~/.cache/icustay'), help='Directory of the query result cache')
+    parser.add_argument('--cache_mb', type=int, default=2048, help='Size limit of the query result cache')
+    parser.add_argument('--cache_days', type=float, default=30, help='Age limit of the cached query results')
+    parser.add_argument('--no_cache', action='store_true', help='Always query the data source')
+    parser.add_argument('--new_cohort', action='store_true', help='Sample new patients instead of reusing the cached cohort')
+    parser.add_argument('--model', default=None, help='Saved CNN-LSTM model (cnn_lstm_model.keras), shows its LOS prediction in the Resume window')
+    args = parser.parse_args()
+
+    source = ParquetSource(args.data_dir) if args.data_dir else BigQuerySource()
+    if not args.no_cache:
+        source = CachedSource(source, args.cache_dir, args.cache_mb * 1024 ** 2, args.cache_days * 24 * 3600, not args.new_cohort)
+    predictor = None
+    if args.model:
+        from los_service import LOSPredictor
+        predictor = LOSPredictor(args.model)
+    asyncio.run(main(source, args.page_size, args.max_in_flight, predictor))
@@ -0,0 +1,61 @@
+'''
+Downsampling of long vital sign series before plotting
+Both methods keep the first and last point and return the indices of the kept points in time order
+'''
+
+# Imports
+import numpy as np
+
+# Min/max per time bucket: keeps the lowest and highest point of every bucket, so peaks survive
+def minmax_indices(x, y, n_buckets):
+    n = len(x)
+    if n <= 2 * n_buckets:
+        return np.arange(n)
+    x = np.asarray(x).astype(np.int64)
+    span = max(int(x[-1] - x[0]), 1)
+    # In float64, nanosecond spans times n_buckets overflow int64 for stays of a few months
+    buckets = np.minimum(((x - x[0]) / span * n_buckets).astype(np.int64), n_buckets - 1)
+
+    # Within every bucket the points sorted by value, the first is the min and the last the max
+    order = np.lexsort((y, buckets))
+    sorted_buckets = buckets[order]
+    firsts = np.flatnonzero(np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]])
+    lasts = np.r_[firsts[1:] - 1, n - 1]
+    return np.unique(np.r_[0, order[firsts], order[lasts], n - 1])
+
+# Largest-Triangle-Three-Buckets, keeps the point of every bucket that forms the largest
+# triangle with the previously kept point and the mean of the next bucket
+def lttb_indices(x, y, n_out):
+    n = len(x)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x).astype(np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    previous = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        next_x, next_y = x[end:next_end].mean(), y[end:next_end].mean()
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        indices[i + 1] = previous
+    return indices
+
+# Downsample one series to a point budget, NaN values are dropped first
+def downsample(x, y, max_points, method='minmax'):
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=np.float64)
+    valid = ~np.isnan(y)
+    x, y = x[valid], y[valid]
+    if len(x) <= max_points:
+        return x, y
+    if method == 'lttb':
+        keep = lttb_indices(x, y, max_points)
+    else:
+        keep = minmax_indices(x, y, max_points // 2)
+    return x[keep], y[keep]
@@ -0,0 +1,432 @@
+'''
+Local LOS prediction service for the CNN-LSTM model of cdle_CNN (cnn_lstm_model.keras)
+The model is loaded once with TensorFlow on the CPU and its forward pass is run with NumPy on the Keras weights,
+so concurrent requests are micro-batched and the recurrent state of every stay is kept:
+new chart events of a stay only run the new time steps (and the padding after them), not the whole sequence.
+Used by the Resume window of datav7.py, and from the command line or over HTTP
+'''
+
+# Imports
+import argparse
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+from sequence_batches import sequence_steps
+from result_tables import split_results
+
+# Activations of the layers of the model
+activations = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'tanh': np.tanh,
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+}
+
+# Activation of a layer by its Keras name
+def activation(name):
+    if name not in activations:
+        raise ValueError(f'Unsupported activation {name}')
+    return activations[name]
+
+# NumPy forward pass of a Sequential model made of pointwise Conv1D, LSTM, Dense, LeakyReLU and Dropout layers
+# Layers before the last LSTM run on every time step, layers after it on its final output
+class StepModel:
+    def __init__(self, layers, max_length, input_dim):
+        self.max_length = max_length
+        self.input_dim = input_dim
+        self.step_layers = []
+        self.head_layers = []
+        self.lstm_units = []
+        in_head = False
+        for layer in layers:
+            kind = type(layer).__name__
+            config = layer.get_config()
+            weights = layer.get_weights()
+            target = self.head_layers if in_head else self.step_layers
+            if kind == 'Conv1D':
+                if weights[0].shape[0] != 1:
+                    raise ValueError('Only Conv1D layers with kernel size 1 run step by step')
+                target.append(('dense', weights[0][0], weights[1], activation(config['activation'])))
+            elif kind == 'Dense':
+                target.append(('dense', weights[0], weights[1], activation(config['activation'])))
+            elif kind == 'LeakyReLU':
+                target.append(('leaky', config.get('negative_slope', config.get('alpha', 0.3))))
+            elif kind == 'LSTM':
+                if in_head:
+                    raise ValueError('Only the last LSTM layer may return its last output only')
+                self.step_layers.append(('lstm', weights[0], weights[1], weights[2],
+                                         activation(config['activation']), activation(config['recurrent_activation'])))
+                self.lstm_units.append(weights[1].shape[0])
+                # Layers after an LSTM that returns only its last output run once per sequence
+                in_head = not config['return_sequences']
+            elif kind not in ('Dropout', 'InputLayer'):
+                raise ValueError(f'Unsupported layer {kind}')
+        if not in_head:
+            raise ValueError('The model must end with an LSTM that returns its last output followed by the output layers')
+        # Time steps after the end of a stay are padded with -1 rows, like in the notebooks
+        self.pad_row = np.full(input_dim, -1.0, dtype=np.float32)
+
+    # Zero (h, c) of every LSTM layer for a batch
+    def initial_states(self, batch):
+        return [(np.zeros((batch, units), dtype=np.float32), np.zeros((batch, units), dtype=np.float32)) for units in self.lstm_units]
+
+    # Apply a pointwise layer
+    @staticmethod
+    def pointwise(layer, x):
+        if layer[0] == 'dense':
+            return layer[3](x @ layer[1] + layer[2])
+        return np.where(x >= 0, x, layer[1] * x)
+
+    # Run the model on x (batch x steps x input_dim) starting at global step first
+    # Sample b only starts at step starts[b] from states[b], its states before step captures[b] are returned with the outputs
+    def forward(self, x, first, starts, states, captures):
+        batch, steps = x.shape[:2]
+        t = first + np.arange(steps)
+        active = t[None, :] >= starts[:, None]
+        captured = []
+        layer_index = 0
+        for layer in self.step_layers:
+            if layer[0] != 'lstm':
+                x = self.pointwise(layer, x)
+                continue
+            _, kernel, recurrent, bias, act, recurrent_act = layer
+            h, c = states[layer_index]
+            h, c = h.copy(), c.copy()
+            cap_h, cap_c = h.copy(), c.copy()
+            projected = x @ kernel + bias
+            outputs = np.empty((batch, steps, recurrent.shape[0]), dtype=np.float32)
+            for step in range(steps):
+                at_capture = captures == t[step]
+                cap_h[at_capture], cap_c[at_capture] = h[at_capture], c[at_capture]
+                z = projected[:, step] + h @ recurrent
+                i, f, g, o = np.split(z, 4, axis=1)
+                new_c = recurrent_act(f) * c + recurrent_act(i) * act(g)
+                new_h = recurrent_act(o) * act(new_c)
+                keep = active[:, step:step + 1]
+                c = np.where(keep, new_c, c)
+                h = np.where(keep, new_h, h)
+                outputs[:, step] = h
+            at_capture = captures >= first + steps
+            cap_h[at_capture], cap_c[at_capture] = h[at_capture], c[at_capture]
+            captured.append((cap_h, cap_c))
+            x = outputs
+            layer_index += 1
+        out = x[:, -1]
+        for layer in self.head_layers:
+            out = self.pointwise(layer, out)
+        return out[:, 0], captured
+
+# Load the Keras model on the CPU and wrap its weights in a StepModel
+# With verify the NumPy forward pass is checked against Keras on random sequences
+def load_model(model_path, verify=True):
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '-1')
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model(model_path, compile=False)
+    _, max_length, input_dim = model.input_shape
+    step_model = StepModel(model.layers, max_length, input_dim)
+    if verify:
+        x = np.random.default_rng(0).normal(size=(2, max_length, input_dim)).astype(np.float32)
+        expected = np.asarray(model(x, training=False))[:, 0]
+        got, _ = step_model.forward(x, 0, np.zeros(2, dtype=np.int64), step_model.initial_states(2), np.zeros(2, dtype=np.int64))
+        if not np.allclose(expected, got, rtol=1e-3, atol=1e-3):
+            raise ValueError(f'The NumPy forward pass does not match the Keras model: {expected} != {got}')
+    return step_model
+
+# Chart events of a stay as sorted (CHARTTIME ns, ITEMID, VALUE) arrays
+# events is a DataFrame (or dict of lists) with CHARTTIME, ITEMID and VALUE
+def event_arrays(events):
+    events = pd.DataFrame(events, columns=['CHARTTIME', 'ITEMID', 'VALUE'])
+    charttime = pd.to_datetime(events['CHARTTIME'], utc=True).dt.tz_localize(None).to_numpy(dtype='datetime64[ns]').view(np.int64)
+    order = np.argsort(charttime, kind='stable')
+    itemids = events['ITEMID'].to_numpy(dtype=np.float32)[order]
+    values = pd.to_numeric(events['VALUE'], errors='coerce').to_numpy(dtype=np.float32)[order]
+    return charttime[order], itemids, values
+
+# Digest of the events of a stay, a repeated request with the same events is answered from the cache
+def events_digest(charttime, itemids, values):
+    digest = hashlib.blake2b(digest_size=16)
+    for array in (charttime, itemids, values):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+# Latency and throughput of the served requests
+class LatencyStats:
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.count = 0
+        self.first = None
+        self.last = None
+        self.lock = threading.Lock()
+
+    def record(self, started, finished):
+        with self.lock:
+            self.latencies.append(finished - started)
+            self.count += 1
+            self.first = started if self.first is None else min(self.first, started)
+            self.last = finished if self.last is None else max(self.last, finished)
+
+    def record_batch(self, size):
+        with self.lock:
+            self.batch_sizes.append(size)
+
+    def summary(self):
+        with self.lock:
+            if not self.latencies:
+                return {'requests': 0}
+            latencies = np.array(self.latencies) * 1000
+            return {
+                'requests': self.count,
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p99_ms': float(np.percentile(latencies, 99)),
+                'throughput_per_s': self.count / max(self.last - self.first, 1e-9),
+                'mean_batch': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+            }
+
+# Micro-batched LOS predictions with a per stay cache of predictions and recurrent states
+# Requests wait at most max_wait_ms for other requests to share their batch
+class LOSPredictor:
+    def __init__(self, model, max_batch=32, max_wait_ms=5, cache_size=4096):
+        self.model = load_model(model) if isinstance(model, str) else model
+        self.max_pairs = (self.model.input_dim - 1) // 2
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = LatencyStats()
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self.serve, daemon=True)
+        self.worker.start()
+
+    # Predict the LOS of a stay from all of its chart events, returns a Future of the prediction in days
+    def predict(self, stay, events):
+        started = time.perf_counter()
+        charttime, itemids, values = event_arrays(events)
+        digest = events_digest(charttime, itemids, values)
+        with self.lock:
+            entry = self.cache.get(stay)
+            if entry is not None and entry['digest'] == digest:
+                self.cache.move_to_end(stay)
+                future = Future()
+                future.set_result(entry['prediction'])
+                self.stats.record(started, time.perf_counter())
+                return future
+        return self.submit(('predict', stay, (charttime, itemids, values, digest)), started)
+
+    # Update the prediction of a cached stay with its new chart events only
+    # Raises KeyError through the Future when the stay was never predicted
+    def update(self, stay, new_events):
+        return self.submit(('update', stay, event_arrays(new_events)), time.perf_counter())
+
+    def submit(self, request, started):
+        future = Future()
+        self.requests.put((request, future, started))
+        return future
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
+
+    # Collect requests into batches: the first request waits at most max_wait for others
+    def serve(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.requests.put(None)
+                    break
+                batch.append(item)
+            # A stay with several requests in the batch is updated in order, one round per request
+            while batch:
+                round_stays, current, later = set(), [], []
+                for item in batch:
+                    (later if item[0][1] in round_stays else current).append(item)
+                    round_stays.add(item[0][1])
+                self.run_batch(current)
+                batch = later
+
+    # Cache entry of a stay whose steps start at start_time, the state before its last step is kept
+    # so that new events of the same minute recompute only that step
+    def prepare(self, request):
+        kind, stay, arrays = request
+        if kind == 'predict':
+            charttime, itemids, values, digest = arrays
+            if len(charttime) == 0:
+                raise ValueError(f'ICU stay {stay} has no chart events')
+            entry = {'start_time': charttime[0], 'steps': 0, 'states': None, 'digest': digest}
+            tail = (charttime, itemids, values)
+        else:
+            with self.lock:
+                if stay not in self.cache:
+                    raise KeyError(f'ICU stay {stay} has no cached prediction, send all of its events to predict')
+                entry = dict(self.cache[stay])
+            charttime, itemids, values = arrays
+            if len(charttime) == 0 or entry['frozen']:
+                return entry, None
+            if charttime[0] < entry['last_time']:
+                raise ValueError(f'New events of ICU stay {stay} are older than its cached events, send all of them to predict')
+            last_charttime, last_itemids, last_values = entry['last_step']
+            tail = (np.concatenate([last_charttime, charttime]), np.concatenate([last_itemids, itemids]),
+                    np.concatenate([last_values, values]))
+            entry['steps'] -= 1
+            entry['digest'] = None
+
+        charttime, itemids, values = tail
+        minutes = (charttime - entry['start_time']) // (60 * 10 ** 9)
+        rows = sequence_steps(minutes, itemids, values, self.max_pairs)
+        # Stays longer than the model input are cut like in training, later events no longer change the prediction
+        first = entry['steps']
+        entry['frozen'] = first + len(rows) > self.model.max_length
+        rows = rows[:self.model.max_length - first]
+        # Raw events of the last minute step, replayed when new events of the same minute arrive
+        last_minute = minutes == minutes[-1]
+        entry['last_step'] = (charttime[last_minute], itemids[last_minute], values[last_minute])
+        entry['last_time'] = charttime[-1]
+        entry['steps'] = first + len(rows)
+        return entry, (first, rows)
+
+    # Run the forward pass of a batch of requests, every request starts from its own cached step
+    def run_batch(self, batch):
+        jobs = []
+        for request, future, started in batch:
+            try:
+                entry, work = self.prepare(request)
+            except Exception as error:
+                future.set_exception(error)
+                self.stats.record(started, time.perf_counter())
+                continue
+            if work is None:
+                future.set_result(entry['prediction'])
+                self.stats.record(started, time.perf_counter())
+                continue
+            jobs.append((request[1], entry, work, future, started))
+        if not jobs:
+            return
+
+        max_length, model = self.model.max_length, self.model
+        first = min(work[0] for _, _, work, _, _ in jobs)
+        x = np.broadcast_to(model.pad_row, (len(jobs), max_length - first, model.input_dim)).copy()
+        starts = np.empty(len(jobs), dtype=np.int64)
+        captures = np.empty(len(jobs), dtype=np.int64)
+        states = model.initial_states(len(jobs))
+        for b, (_, entry, (start, rows), _, _) in enumerate(jobs):
+            x[b, start - first:start - first + len(rows)] = rows
+            starts[b] = start
+            captures[b] = entry['steps'] - 1 if not entry['frozen'] else max_length
+            if entry['states'] is not None:
+                for layer, (h, c) in enumerate(entry['states']):
+                    states[layer][0][b], states[layer][1][b] = h, c
+        predictions, captured = model.forward(x, first, starts, states, captures)
+
+        self.stats.record_batch(len(jobs))
+        finished = time.perf_counter()
+        with self.lock:
+            for b, (stay, entry, _, future, started) in enumerate(jobs):
+                entry['states'] = [(h[b].copy(), c[b].copy()) for h, c in captured]
+                entry['prediction'] = float(predictions[b])
+                self.cache[stay] = entry
+                self.cache.move_to_end(stay)
+                future.set_result(entry['prediction'])
+                self.stats.record(started, finished)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+# HTTP endpoint: POST /predict and /update with {"icustay_id": ..., "events": [{"CHARTTIME", "ITEMID", "VALUE"}, ...]},
+# GET /stats for the latency percentiles and throughput
+def make_handler(predictor):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.reply(200, predictor.stats.summary())
+            else:
+                self.reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path not in ('/predict', '/update'):
+                self.reply(404, {'error': 'not found'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                stay = int(body['icustay_id'])
+                events = body['events']
+                submit = predictor.predict if self.path == '/predict' else predictor.update
+                self.reply(200, {'icustay_id': stay, 'los': submit(stay, events).result()})
+            except KeyError as error:
+                self.reply(404, {'error': str(error)})
+            except Exception as error:
+                self.reply(400, {'error': str(error)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+# Predict every stay of the patients from the command line, concurrently so requests share batches
+def predict_patients(predictor, source, patients, workers=8):
+    stays, events = split_results(source.fetch_data(patients))
+    stay_events = {stay: group for stay, group in events.groupby('ICUSTAY_ID', sort=False)}
+
+    def predict(stay):
+        group = stay_events[stay]
+        frame = {'CHARTTIME': group['CHARTTIME'].to_numpy().view('datetime64[ns]'), 'ITEMID': group['ITEMID'], 'VALUE': group['VALUE']}
+        return stay, predictor.predict(stay, frame).result()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for stay, los in executor.map(predict, stays.index):
+            print(f"ICU stay {stay}: predicted LOS {los:.2f} days, actual {stays.loc[stay, 'LOS']:.2f} days")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='cnn_lstm_model.keras', help='Saved Keras CNN-LSTM model')
+    parser.add_argument('--max_batch', type=int, default=32, help='Requests per forward pass')
+    parser.add_argument('--max_wait_ms', type=float, default=5, help='Longest wait of a request for others to share its batch')
+    parser.add_argument('--serve', action='store_true', help='Serve predictions over HTTP instead of predicting --patients')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--patients', default=None, help='Comma separated SUBJECT_IDs to predict')
+    parser.add_argument('--data_dir', default=None, help='Directory with Parquet copies of the MIMIC tables, used instead of BigQuery')
+    args = parser.parse_args()
+
+    predictor = LOSPredictor(args.model, args.max_batch, args.max_wait_ms)
+    if args.serve:
+        server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(predictor))
+        print(f'Serving LOS predictions on http://127.0.0.1:{args.port}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        from data_sources import BigQuerySource, ParquetSource
+
+        source = ParquetSource(args.data_dir) if args.data_dir else BigQuerySource()
+        patients = [int(p) for p in args.patients.split(',')] if args.patients else list(source.fetch_subject_ids()['SUBJECT_ID'].unique())
+        predict_patients(predictor, source, patients)
+    print(json.dumps(predictor.stats.summary()))
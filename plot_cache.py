@@ -0,0 +1,42 @@
+'''
+Thread safe LRU cache of rendered plot images, bounded by the total size of the images
+'''
+
+# Imports
+import threading
+from collections import OrderedDict
+
+# Least recently used images are evicted once the cache holds more than max_bytes
+class PlotCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            image = self.entries.get(key)
+            if image is not None:
+                self.entries.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            if len(image) > self.max_bytes:
+                return
+            self.entries[key] = image
+            self.size += len(image)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
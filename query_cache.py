@@ -0,0 +1,141 @@
+'''
+On-disk Parquet cache of the fetch_data results of a data source
+Entries are keyed by the source cache key (normalized query and item_ids) and hold the rows of a set of patients,
+so a request for cached and new patients only fetches the new ones
+Entries are evicted when older than max_age or, least recently used first, when the cache grows above max_bytes
+'''
+
+# Imports
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from span_timer import span, timer
+
+# Wraps a data source (see data_sources.py) with the cache
+class CachedSource:
+    def __init__(self, source, cache_dir, max_bytes=2 * 1024 ** 3, max_age=30 * 24 * 3600, reuse_cohort=True):
+        self.source = source
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.reuse_cohort = reuse_cohort
+        self.key = hashlib.sha256(source.cache_key().encode()).hexdigest()[:16]
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.index = self.load_index()
+        with self.lock:
+            self.evict()
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    # Written to a temporary file first, so a crash never leaves a half written index
+    def save_index(self):
+        temporary = f'{self.index_path}.{uuid.uuid4().hex}'
+        with open(temporary, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temporary, self.index_path)
+
+    def remove(self, name):
+        self.index.pop(name, None)
+        try:
+            os.remove(os.path.join(self.cache_dir, name))
+        except FileNotFoundError:
+            pass
+
+    # Drop expired entries, then the least recently used ones until the cache fits in max_bytes
+    def evict(self):
+        now = time.time()
+        for name, entry in list(self.index.items()):
+            if now - entry['created'] > self.max_age or not os.path.exists(os.path.join(self.cache_dir, name)):
+                self.remove(name)
+        total = sum(entry['bytes'] for entry in self.index.values())
+        for name, entry in sorted(self.index.items(), key=lambda item: item[1]['last_used']):
+            if total <= self.max_bytes:
+                break
+            total -= entry['bytes']
+            self.remove(name)
+        self.save_index()
+
+    def store(self, results, patients, kind='data'):
+        name = f'{self.key}-{kind}-{uuid.uuid4().hex}.parquet'
+        path = os.path.join(self.cache_dir, name)
+        pq.write_table(pa.Table.from_pandas(results, preserve_index=False), path)
+        now = time.time()
+        with self.lock:
+            self.index[name] = {'key': self.key, 'kind': kind, 'patients': [int(p) for p in patients],
+                                'created': now, 'last_used': now, 'bytes': os.path.getsize(path)}
+            self.evict()
+
+    # Memory mapped read of an entry, restricted to the given patients
+    def read(self, name, patients=None):
+        filters = [('SUBJECT_ID', 'in', sorted(patients))] if patients is not None else None
+        with span('cache read'):
+            table = pq.read_table(os.path.join(self.cache_dir, name), memory_map=True, filters=filters)
+            return table.to_pandas()
+
+    # Cached rows of the patients that are cached, the other patients are fetched from the source and cached
+    def fetch_data(self, patients):
+        wanted = {int(p) for p in patients}
+        covering = {}
+        claimed = set()
+        with self.lock:
+            for name, entry in self.index.items():
+                if entry['key'] != self.key or entry['kind'] != 'data':
+                    continue
+                hit = wanted.intersection(entry['patients']) - claimed
+                if hit:
+                    covering[name] = hit
+                    claimed |= hit
+                    entry['last_used'] = time.time()
+            if covering:
+                self.save_index()
+
+        frames = []
+        covered = set()
+        for name, hit in covering.items():
+            try:
+                frames.append(self.read(name, hit))
+                covered |= hit
+            except FileNotFoundError:
+                pass  # Evicted by another thread, fetched again below
+
+        missing = [p for p in patients if int(p) not in covered]
+        if missing:
+            fetched = self.source.fetch_data(missing)
+            self.store(fetched, missing)
+            frames.append(fetched)
+        # Hit counts are only printed while the viewer is timed (ICUSTAY_TIMING)
+        if timer is not None:
+            print(f"Query cache: {len(covered)} patients cached, {len(missing)} fetched")  # Debugging
+
+        results = pd.concat([frame for frame in frames if len(frame)] or frames, ignore_index=True)
+        return results.sort_values(['ICUSTAY_ID', 'CHARTTIME'], kind='stable').reset_index(drop=True)
+
+    # The sampled cohort is cached too, so a repeat session reviews the same patients
+    def fetch_subject_ids(self):
+        if self.reuse_cohort:
+            with self.lock:
+                cohorts = [name for name, entry in self.index.items() if entry['key'] == self.key and entry['kind'] == 'cohort']
+            for name in cohorts:
+                try:
+                    return self.read(name)
+                except FileNotFoundError:
+                    pass
+        cohort = self.source.fetch_subject_ids()
+        with self.lock:
+            for name, entry in list(self.index.items()):
+                if entry['key'] == self.key and entry['kind'] == 'cohort':
+                    self.remove(name)
+        self.store(cohort, [], kind='cohort')
+        return cohort
@@ -0,0 +1,106 @@
+'''
+Cohort wide time-in-range analysis of the vital signs against the normal ranges in vital_items.py
+One vectorized pass over the events table (see result_tables.py) gives, for every (ICUSTAY_ID, ITEMID) series,
+the time weighted fraction below, in and above range, the number of excursions and the longest excursion
+Every measure holds until the next measure of the same series, the last one has no duration
+'''
+
+# Imports
+import numpy as np
+import pandas as pd
+from vital_items import normal_ranges, unit_aliases, unit_conversions
+
+# Columns of the range table
+RANGE_COLUMNS = ['ICUSTAY_ID', 'ITEMID', 'NAME', 'LABEL', 'UNIT', 'LOW', 'HIGH', 'COUNT', 'MEAN', 'MIN', 'MAX',
+                 'FRAC_BELOW', 'FRAC_IN', 'FRAC_ABOVE', 'EXCURSIONS', 'LONGEST_EXCURSION_HOURS', 'FRAC_IN_PERCENTILE']
+
+# Canonical spelling of VALUEUOM values
+def normalize_units(units):
+    return np.array([unit_aliases.get(str(unit).strip().lower(), unit) for unit in units], dtype=object)
+
+# Convert the values measured in another unit to the unit of their normal range
+def convert_units(values, units, target_units):
+    values = values.copy()
+    for (source, target), (scale, offset) in unit_conversions.items():
+        convert = (units == source) & (target_units == target)
+        values[convert] = values[convert] * scale + offset
+    return values
+
+# Range statistics of every (ICUSTAY_ID, ITEMID) series of the events table, ordered by ICUSTAY_ID
+def range_table(events):
+    events = events[events['ITEMID'].isin(list(normal_ranges)) & events['VALUE'].notna()]
+    if len(events) == 0:
+        return pd.DataFrame(columns=RANGE_COLUMNS)
+
+    stays = events['ICUSTAY_ID'].to_numpy(dtype=np.int64)
+    items = events['ITEMID'].to_numpy(dtype=np.int64)
+    times = events['CHARTTIME'].to_numpy(dtype=np.int64)
+    order = np.lexsort((times, items, stays))
+    stays, items, times = stays[order], items[order], times[order]
+
+    ranges = pd.DataFrame.from_dict(normal_ranges, orient='index', columns=['NAME', 'LOW', 'HIGH', 'UNIT']).reindex(items)
+    low, high = ranges['LOW'].to_numpy(), ranges['HIGH'].to_numpy()
+    units = normalize_units(events['VALUEUOM'].to_numpy()[order])
+    values = convert_units(events['VALUE'].to_numpy(dtype=np.float64)[order], units, ranges['UNIT'].to_numpy())
+
+    # Series boundaries and the hours every measure holds until the next one of its series
+    new_series = np.r_[True, (stays[1:] != stays[:-1]) | (items[1:] != items[:-1])]
+    starts = np.flatnonzero(new_series)
+    series = np.cumsum(new_series) - 1
+    n_series = len(starts)
+    last_of_series = np.r_[new_series[1:], True]
+    hours = np.where(last_of_series, 0.0, np.r_[np.diff(times), 0] / 3.6e12)
+
+    # A series without any duration (a single measure) is weighted by count
+    weights = np.where(np.bincount(series, hours, n_series)[series] > 0, hours, 1.0)
+    total = np.bincount(series, weights, n_series)
+    state = np.where(values < low, -1, np.where(values > high, 1, 0))
+    below = np.bincount(series, weights * (state < 0), n_series) / total
+    above = np.bincount(series, weights * (state > 0), n_series) / total
+
+    # Excursions are runs of consecutive measures on the same side out of range
+    run_start = new_series | (state != np.r_[0, state[:-1]])
+    run_hours = np.bincount(np.cumsum(run_start) - 1, hours)
+    out = state[run_start] != 0
+    longest = np.zeros(n_series)
+    np.maximum.at(longest, series[run_start][out], run_hours[out])
+
+    counts = np.bincount(series, minlength=n_series)
+    table = pd.DataFrame({
+        'ICUSTAY_ID': stays[starts],
+        'ITEMID': items[starts],
+        'NAME': ranges['NAME'].to_numpy()[starts],
+        'LABEL': np.asarray(events['LABEL'].to_numpy()[order][starts], dtype=object),
+        'UNIT': ranges['UNIT'].to_numpy()[starts],
+        'LOW': low[starts],
+        'HIGH': high[starts],
+        'COUNT': counts,
+        'MEAN': np.bincount(series, values, n_series) / counts,
+        'MIN': np.minimum.reduceat(values, starts),
+        'MAX': np.maximum.reduceat(values, starts),
+        'FRAC_BELOW': below,
+        'FRAC_IN': np.clip(1 - below - above, 0, 1),
+        'FRAC_ABOVE': above,
+        'EXCURSIONS': np.bincount(series, run_start & (state != 0), n_series).astype(np.int64),
+        'LONGEST_EXCURSION_HOURS': longest,
+    })
+    # Where the stay ranks in the loaded cohort for the time in range of the same vital sign
+    table['FRAC_IN_PERCENTILE'] = table.groupby('NAME')['FRAC_IN'].rank(pct=True)
+    return table
+
+# Rows of one stay in a range table
+def stay_ranges(table, stay):
+    icustay_ids = table['ICUSTAY_ID'].to_numpy()
+    return table.iloc[np.searchsorted(icustay_ids, stay, 'left'):np.searchsorted(icustay_ids, stay, 'right')]
+
+# Text lines of the comparative analysis of one stay, shared by the app window and the PDF export
+def range_lines(table):
+    lines = []
+    for row in table.itertuples():
+        lines.append(
+            f"{row.NAME} - Mean: {row.MEAN:.2f} {row.UNIT} (Normal Range: {row.LOW} - {row.HIGH}), "
+            f"Time in range: {row.FRAC_IN:.0%}, below: {row.FRAC_BELOW:.0%}, above: {row.FRAC_ABOVE:.0%}, "
+            f"Excursions: {row.EXCURSIONS}, longest: {row.LONGEST_EXCURSION_HOURS:.1f} h, "
+            f"Cohort percentile: {row.FRAC_IN_PERCENTILE:.0%}"
+        )
+    return lines
@@ -0,0 +1,49 @@
+'''
+Compact in-memory tables of the fetch_data results used by the ICU data visualization app
+The wide result rows are split into a stays table (one row per ICUSTAY_ID with the stay and patient fields)
+and a slim events table (int32 ICUSTAY_ID and ITEMID, categorical LABEL and VALUEUOM, float32 VALUE, int64 CHARTTIME in ns)
+'''
+
+# Imports
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# Fields repeated on every result row that belong to the stay
+STAY_COLUMNS = ['SUBJECT_ID', 'LOS', 'DIAGNOSIS', 'GENDER', 'DOB', 'ADMITTIME']
+
+# Split fetch_data results into the stays and events tables, events are ordered by ICUSTAY_ID and CHARTTIME
+def split_results(results):
+    charttime = pd.to_datetime(results['CHARTTIME'], utc=True).dt.tz_localize(None)
+    order = np.lexsort((charttime.to_numpy(), results['ICUSTAY_ID'].to_numpy()))
+    results = results.iloc[order]
+    charttime = charttime.iloc[order]
+
+    stays = results.drop_duplicates('ICUSTAY_ID').set_index('ICUSTAY_ID')[[c for c in STAY_COLUMNS if c in results.columns]].copy()
+    for column in ('DOB', 'ADMITTIME'):
+        if column in stays.columns:
+            stays[column] = pd.to_datetime(stays[column], utc=True).dt.tz_localize(None)
+
+    events = pd.DataFrame({
+        'ICUSTAY_ID': results['ICUSTAY_ID'].to_numpy(dtype=np.int32),
+        'ITEMID': results['ITEMID'].to_numpy(dtype=np.int32),
+        'LABEL': pd.Categorical(results['LABEL']),
+        'VALUEUOM': pd.Categorical(results['VALUEUOM']),
+        'VALUE': pd.to_numeric(results['VALUE'], errors='coerce').to_numpy(dtype=np.float32),
+        'CHARTTIME': charttime.to_numpy(dtype='datetime64[ns]').view(np.int64),
+    })
+    return stays, events
+
+# Concatenate events tables, the categorical columns keep a shared set of categories
+def concat_events(tables):
+    columns = {}
+    for column, dtype in tables[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            columns[column] = union_categoricals([table[column] for table in tables], ignore_order=True)
+        else:
+            columns[column] = np.concatenate([table[column].to_numpy() for table in tables])
+    return pd.DataFrame(columns)
+
+# CHARTTIME of an events table as datetime64 values
+def charttimes(events):
+    return events['CHARTTIME'].to_numpy().view('datetime64[ns]')
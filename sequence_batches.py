@@ -0,0 +1,206 @@
+'''
+Memory-bounded training batches for the sequence models (RNN, CNN)
+Stays are streamed from the Parquet shards of train_test_csv_creation.py (or taken from a memory-mapped
+StaySequences / StayTensors), grouped with stays of similar length and padded per batch,
+so no array ever holds every stay padded to the longest one. Batches are built on a background thread
+while the model trains on the previous ones.
+'''
+
+# Imports
+import glob
+import queue
+import threading
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from vital_items import item_ids
+from sequence_reader import StayTensors, table_sequences, table_tensors
+
+# Default bucket boundaries of the streamed stays, in time steps
+default_boundaries = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+# Time step rows of a stay of the parquet format: [minute, itemid, value, itemid, value, ...] like the notebooks
+# At most max_pairs measures are kept per time step, the unused columns are missing_value
+def sequence_steps(minutes, itemids, values, max_pairs=len(item_ids), missing_value=-1.0):
+    if len(minutes) == 0:
+        return np.empty((0, 1 + 2 * max_pairs), dtype=np.float32)
+    starts = np.flatnonzero(np.r_[True, minutes[1:] != minutes[:-1]])
+    step = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(minutes)]))
+    rank = np.arange(len(minutes)) - starts[step]
+    keep = rank < max_pairs
+    rows = np.full((len(starts), 1 + 2 * max_pairs), missing_value, dtype=np.float32)
+    rows[:, 0] = minutes[starts]
+    rows[step[keep], 1 + 2 * rank[keep]] = itemids[keep]
+    rows[step[keep], 2 + 2 * rank[keep]] = np.nan_to_num(values[keep], nan=missing_value)
+    return rows
+
+# Time step rows of a stay of the tensor format: [minute, value of every ITEMID], unmeasured values are missing_value
+def tensor_steps(minutes, matrix, missing_value=-1.0):
+    rows = np.empty((len(minutes), 1 + matrix.shape[1]), dtype=np.float32)
+    rows[:, 0] = minutes
+    rows[:, 1:] = np.nan_to_num(matrix, nan=missing_value)
+    return rows
+
+# (LOS, time step rows) of the i-th stay of a StaySequences or StayTensors, cut to its first max_length steps
+def stay_steps(data, i, max_length=None, max_pairs=len(item_ids), missing_value=-1.0):
+    if isinstance(data, StayTensors):
+        minutes, matrix, _ = data[i]
+        steps = tensor_steps(minutes, matrix, missing_value)
+    else:
+        minutes, itemids, values = data[i]
+        steps = sequence_steps(minutes, itemids, values, max_pairs, missing_value)
+    return float(data.los[i]), steps[:max_length]
+
+# Read the stays of the shards of a split one record batch at a time, the format is taken from the columns
+def stream_shards(prefix, read_rows=1024, rng=None):
+    paths = sorted(glob.glob(f'{prefix}*.parquet'))
+    if not paths:
+        raise FileNotFoundError(f'No parquet shards found for {prefix}')
+    if rng is not None:
+        rng.shuffle(paths)
+    for path in paths:
+        shard = pq.ParquetFile(path)
+        for batch in shard.iter_batches(batch_size=read_rows):
+            table = pa.Table.from_batches([batch])
+            yield table_tensors(table) if 'VALUES' in table.column_names else table_sequences(table)
+
+# Pad a list of (LOS, steps) to the longest stay of the batch
+# Returns X (batch x time step x feature), y (LOS) and the number of time steps of every stay
+def pad_batch(stays, pad_value=-1.0):
+    lengths = np.array([len(steps) for _, steps in stays], dtype=np.int64)
+    width = stays[0][1].shape[1]
+    x = np.full((len(stays), max(lengths.max(), 1), width), pad_value, dtype=np.float32)
+    for row, (_, steps) in enumerate(stays):
+        x[row, :len(steps)] = steps
+    y = np.array([los for los, _ in stays], dtype=np.float32)
+    return x, y, lengths
+
+# Ragged form of a list of (LOS, steps): the time steps of every stay stacked, plus the number of time steps of every stay
+# tf.RaggedTensor.from_row_lengths(values, lengths) builds the ragged batch without any padding
+def ragged_batch(stays):
+    lengths = np.array([len(steps) for _, steps in stays], dtype=np.int64)
+    values = np.concatenate([steps for _, steps in stays])
+    y = np.array([los for los, _ in stays], dtype=np.float32)
+    return values, y, lengths
+
+# Batches of stay indices with similar length: sorted by length (ties broken at random), then the batch order is shuffled
+def sorted_batches(lengths, batch_size, rng=None):
+    noise = rng.random(len(lengths)) if rng is not None else np.zeros(len(lengths))
+    order = np.lexsort((noise, lengths))
+    batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+    if rng is not None:
+        rng.shuffle(batches)
+    return batches
+
+# Group streamed (LOS, steps) into batches of stays of the same length bucket
+# A bucket is emitted as soon as it holds batch_size stays, so at most len(boundaries) + 1 partial batches are held
+def bucket_batches(stays, batch_size, boundaries=default_boundaries):
+    buckets = [[] for _ in range(len(boundaries) + 1)]
+    for stay in stays:
+        bucket = buckets[np.searchsorted(boundaries, len(stay[1]), side='right')]
+        bucket.append(stay)
+        if len(bucket) == batch_size:
+            yield list(bucket)
+            bucket.clear()
+    for bucket in buckets:
+        if bucket:
+            yield bucket
+
+# Run an iterator on a background thread, at most depth items are built ahead of the consumer
+def prefetch(iterator, depth=2):
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    # Hand an item to the consumer, False once the consumer is gone
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+            put(done)
+        except Exception as error:
+            put(error)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+# Length-bucketed batches of a split, every iteration is one epoch
+# source is either a shard prefix (e.g. 'output/training'), streamed a record batch at a time,
+# or a StaySequences / StayTensors from sequence_reader, batched by sorted length
+# Every batch is (X, y, lengths), X is padded to the longest stay of the batch, or stacked with ragged=True
+class BatchLoader:
+    def __init__(self, source, batch_size=128, boundaries=default_boundaries, max_length=None, max_pairs=len(item_ids),
+                 ragged=False, pad_value=-1.0, shuffle=True, seed=0, prefetch_batches=2, read_rows=1024):
+        self.source = source
+        self.batch_size = batch_size
+        self.boundaries = boundaries
+        self.max_length = max_length
+        self.max_pairs = max_pairs
+        self.ragged = ragged
+        self.pad_value = pad_value
+        self.shuffle = shuffle
+        self.seed = seed
+        self.prefetch_batches = prefetch_batches
+        self.read_rows = read_rows
+        self.epoch = 0
+
+    # Number of batches, only known for in-memory sources
+    def __len__(self):
+        if isinstance(self.source, str):
+            raise TypeError('The number of batches of a streamed source is not known in advance')
+        return -(-len(self.source) // self.batch_size)
+
+    # (LOS, steps) of every stay of a streamed source, stays are shuffled within every record batch
+    def streamed_stays(self, rng):
+        for data in stream_shards(self.source, self.read_rows, rng):
+            order = rng.permutation(len(data)) if rng is not None else range(len(data))
+            for i in order:
+                yield stay_steps(data, i, self.max_length, self.max_pairs, self.pad_value)
+
+    # Lists of (LOS, steps) of one epoch
+    def stay_batches(self, rng):
+        if isinstance(self.source, str):
+            yield from bucket_batches(self.streamed_stays(rng), self.batch_size, self.boundaries)
+            return
+        lengths = self.source.lengths() if isinstance(self.source, StayTensors) else self.step_counts()
+        if self.max_length:
+            lengths = np.minimum(lengths, self.max_length)
+        for indices in sorted_batches(lengths, self.batch_size, rng):
+            yield [stay_steps(self.source, i, self.max_length, self.max_pairs, self.pad_value) for i in indices]
+
+    # Number of time steps (distinct minutes) of every stay of a StaySequences
+    def step_counts(self):
+        minutes, offsets = self.source.minutes, self.source.offsets
+        new_step = np.r_[True, minutes[1:] != minutes[:-1]]
+        new_step[offsets[:-1][offsets[:-1] < len(minutes)]] = True
+        total = np.r_[0, np.cumsum(new_step)]
+        return total[offsets[1:]] - total[offsets[:-1]]
+
+    def batches(self, rng):
+        for stays in self.stay_batches(rng):
+            yield ragged_batch(stays) if self.ragged else pad_batch(stays, self.pad_value)
+
+    def __iter__(self):
+        rng = np.random.default_rng((self.seed, self.epoch)) if self.shuffle else None
+        self.epoch += 1
+        return prefetch(self.batches(rng), self.prefetch_batches)
@@ -0,0 +1,116 @@
+'''
+Reader for the columnar sequence output of train_test_csv_creation.py
+(--output_format parquet and --output_format tensor). Returns NumPy views over the Arrow buffers,
+no Python level parsing of the sequences is done.
+'''
+
+# Imports
+import glob
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Flat arrays of every stay in a split, row i spans offsets[i]:offsets[i + 1]
+class StaySequences:
+    def __init__(self, icustay_ids, los, offsets, minutes, itemids, values):
+        self.icustay_ids = icustay_ids
+        self.los = los
+        self.offsets = offsets
+        self.minutes = minutes
+        self.itemids = itemids
+        self.values = values
+
+    def __len__(self):
+        return len(self.icustay_ids)
+
+    # Views of the minute offsets, ITEMIDs and values of the i-th stay
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.minutes[start:end], self.itemids[start:end], self.values[start:end]
+
+    # Number of chart events of every stay
+    def lengths(self):
+        return np.diff(self.offsets)
+
+# Dense tensors of every stay in a split, stay i spans rows offsets[i]:offsets[i + 1] of matrix and mask
+# Without a mask (shards written before MASK was added) the values that are not NaN are taken as measured
+class StayTensors:
+    def __init__(self, icustay_ids, los, offsets, minutes, matrix, mask=None):
+        self.icustay_ids = icustay_ids
+        self.los = los
+        self.offsets = offsets
+        self.minutes = minutes
+        self.matrix = matrix
+        self.mask = mask
+
+    def __len__(self):
+        return len(self.icustay_ids)
+
+    # Views of the time steps and the time step x ITEMID matrix of the i-th stay, plus its measured mask
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        matrix = self.matrix[start:end]
+        mask = self.mask[start:end] if self.mask is not None else ~np.isnan(matrix)
+        return self.minutes[start:end], matrix, mask
+
+    # Number of time steps of every stay
+    def lengths(self):
+        return np.diff(self.offsets)
+
+# Flatten a list column into (offsets, values) NumPy arrays
+def list_column(column):
+    array = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    offsets = array.offsets.to_numpy()
+    values = array.flatten().to_numpy(zero_copy_only=False)
+    return offsets - offsets[0], values
+
+# Read every shard matching the prefix (e.g. 'output/training') into one table
+def read_shards(prefix, memory_map=True):
+    paths = sorted(glob.glob(f'{prefix}*.parquet'))
+    if not paths:
+        raise FileNotFoundError(f'No parquet shards found for {prefix}')
+    return pa.concat_tables([pq.read_table(path, memory_map=memory_map) for path in paths])
+
+# Read the --output_format parquet shards of a split into a StaySequences
+def read_sequences(prefix, memory_map=True):
+    return table_sequences(read_shards(prefix, memory_map))
+
+# StaySequences of an Arrow table (or record batch) of the --output_format parquet schema
+def table_sequences(table):
+    offsets, minutes = list_column(table.column('MINUTE'))
+    _, itemids = list_column(table.column('ITEMID'))
+    _, values = list_column(table.column('VALUE'))
+    return StaySequences(
+        table.column('ICUSTAY_ID').to_numpy(),
+        table.column('LOS').to_numpy(),
+        offsets,
+        minutes,
+        itemids,
+        values,
+    )
+
+# Read the --output_format tensor shards of a split into a StayTensors
+def read_tensors(prefix, memory_map=True):
+    return table_tensors(read_shards(prefix, memory_map))
+
+# StayTensors of an Arrow table (or record batch) of the --output_format tensor schema
+def table_tensors(table):
+    offsets, minutes = list_column(table.column('MINUTE'))
+    _, values = list_column(table.column('VALUES'))
+    n_items = len(values) // max(len(minutes), 1)
+    mask = None
+    if 'MASK' in table.column_names:
+        _, mask = list_column(table.column('MASK'))
+        mask = mask.reshape(len(minutes), n_items)
+    return StayTensors(
+        table.column('ICUSTAY_ID').to_numpy(),
+        table.column('LOS').to_numpy(),
+        offsets,
+        minutes,
+        values.reshape(len(minutes), n_items),
+        mask,
+    )
+
+# Read the --features table of a split (e.g. 'output/features_training') as a DataFrame indexed by ICUSTAY_ID
+def read_features(prefix, memory_map=True):
+    return read_shards(prefix, memory_map).to_pandas().set_index('ICUSTAY_ID')
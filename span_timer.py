@@ -0,0 +1,122 @@
+'''
+Lightweight span timer of the ICU data visualization app, off unless ICUSTAY_TIMING is set
+ICUSTAY_TIMING=1 records a latency histogram per operation and writes them as JSON when the app exits
+(to ICUSTAY_TIMING_FILE, default icustay_timing.json), ICUSTAY_TIMING=profile also profiles the Tk thread with cProfile
+(written next to it as .prof, e.g. `python -m pstats icustay_timing.prof`)
+'''
+
+# Imports
+import atexit
+import bisect
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in milliseconds, the last bucket holds everything slower
+bucket_bounds = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+# Latency histogram of one operation
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(bucket_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(bucket_bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.min = min(self.min, ms)
+        self.max = max(self.max, ms)
+
+    # Upper bound of the bucket holding the given quantile
+    def quantile(self, q):
+        seen = 0
+        for bound, count in zip(bucket_bounds + (self.max,), self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total,
+            'mean_ms': self.total / self.count,
+            'min_ms': self.min,
+            'max_ms': self.max,
+            'p50_ms': self.quantile(0.5),
+            'p99_ms': self.quantile(0.99),
+            'buckets_ms': {str(bound): count for bound, count in zip(bucket_bounds + ('inf',), self.counts) if count},
+        }
+
+# Histograms of every operation, shared by the Tk thread, the render workers and the page loader
+class SpanTimer:
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.profiler = None
+
+    def record(self, name, ms):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].add(ms)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000)
+
+    def summary(self):
+        with self.lock:
+            return {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}
+
+    def dump_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    # Profile the calling thread until dump_profile
+    def start_profile(self):
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def dump_profile(self, path):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(path)
+
+    # Write the histograms (and the profile), then print one line per operation
+    def dump(self, path):
+        self.dump_json(path)
+        self.dump_profile(os.path.splitext(path)[0] + '.prof')
+        for name, stats in self.summary().items():
+            print(f"{name}: {stats['count']} calls, p50 {stats['p50_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms, "
+                  f"max {stats['max_ms']:.1f} ms")
+        print(f"Timings written to {path}")
+
+mode = os.environ.get('ICUSTAY_TIMING', '').lower()
+timer = SpanTimer() if mode and mode not in ('0', 'false') else None
+if timer is not None:
+    if mode == 'profile':
+        timer.start_profile()
+    atexit.register(timer.dump, os.environ.get('ICUSTAY_TIMING_FILE', 'icustay_timing.json'))
+
+# Time a block as the operation name, a no-op unless the timer is enabled
+def span(name):
+    if timer is None:
+        return contextlib.nullcontext()
+    return timer.span(name)
+
+# Record a latency measured by the caller, for operations that span several Tk callbacks
+def record(name, ms):
+    if timer is not None:
+        timer.record(name, ms)
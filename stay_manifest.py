@@ -0,0 +1,80 @@
+'''
+Manifest of the ICU stays written by train_test_csv_creation.py --incremental
+Every (split, ICUSTAY_ID) is mapped to its fingerprint (max CHARTTIME and content hash)
+and to the output shard that holds it, so a later run only reprocesses new or changed stays
+'''
+
+# Imports
+import json
+from collections import defaultdict
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from apache_beam.io.filesystems import FileSystems
+
+# Load the manifest, a missing file is an empty manifest
+def load_manifest(path):
+    if not FileSystems.exists(path):
+        return {}
+    with FileSystems.open(path) as f:
+        data = json.load(f)
+    return {(entry['split'], entry['icustay_id']): entry for entry in data['stays']}
+
+# Write the manifest back
+def save_manifest(path, manifest):
+    with FileSystems.create(path) as f:
+        f.write(json.dumps({'stays': list(manifest.values())}).encode())
+
+# Paths of every file matching a glob pattern
+def match_paths(pattern):
+    return sorted(metadata.path for metadata in FileSystems.match([pattern])[0].metadata_list)
+
+# ICUSTAY_IDs held by an output shard
+def shard_stays(path):
+    with FileSystems.open(path) as f:
+        return pq.read_table(f, columns=['ICUSTAY_ID']).column('ICUSTAY_ID').to_pylist()
+
+# Rewrite a shard without the given ICUSTAY_IDs, the shard is deleted when nothing is left
+def drop_stays(path, icustay_ids):
+    with FileSystems.open(path) as f:
+        table = pq.read_table(f)
+    table = table.filter(pc.invert(pc.is_in(table.column('ICUSTAY_ID'), value_set=pa.array(sorted(icustay_ids), type=pa.int64()))))
+    if table.num_rows == 0:
+        FileSystems.delete([path])
+        return
+    with FileSystems.create(path) as f:
+        pq.write_table(table, f)
+
+# Merge the shards written by an incremental run into the existing output
+# Only the shards that held an outdated copy of a reprocessed stay are rewritten
+# outputs maps the manifest field of every output to the name of its shards, e.g. {'features_file': 'features_{split}'}
+def merge_run(manifest, output_dir, run_id, splits, outputs={'file': '{split}'}):
+    fingerprint_paths = match_paths(f'{output_dir}/_fingerprints-{run_id}*')
+    updates = {}
+    for path in fingerprint_paths:
+        with FileSystems.open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                updates[(entry['split'], entry['icustay_id'])] = entry
+
+    new_files = defaultdict(dict)
+    stale = defaultdict(set)
+    for field, name in outputs.items():
+        for split in splits:
+            for path in match_paths(f'{output_dir}/{name.format(split=split)}-{run_id}*.parquet'):
+                icustay_ids = shard_stays(path)
+                if not icustay_ids:
+                    FileSystems.delete([path])
+                for icustay_id in icustay_ids:
+                    new_files[(split, icustay_id)][field] = path
+        for key in updates:
+            if key in manifest and manifest[key].get(field):
+                stale[manifest[key][field]].add(key[1])
+    for path, icustay_ids in stale.items():
+        drop_stays(path, icustay_ids)
+
+    for key, entry in updates.items():
+        manifest[key] = {**entry, **{field: new_files[key].get(field) for field in outputs}}
+    if fingerprint_paths:
+        FileSystems.delete(fingerprint_paths)
+    return len(updates), len(stale)
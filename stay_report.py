@@ -0,0 +1,85 @@
+'''
+Figure, summary and PDF report of one ICU stay
+Shared by the ICU data visualization app and the headless batch reports, nothing here needs a display
+'''
+
+# Imports
+import os
+import tempfile
+import pandas as pd
+import plotly.graph_objs as go
+from fpdf import FPDF
+from downsample import downsample
+from result_tables import charttimes
+from range_analysis import range_lines
+
+# Header fields of a stay from its row of the stays table
+def stay_header(stay_row):
+    dob = pd.to_datetime(stay_row['DOB'])
+    admit_time = pd.to_datetime(stay_row['ADMITTIME'])
+    return {
+        'subject_id': stay_row['SUBJECT_ID'],
+        'diagnosis': stay_row['DIAGNOSIS'] if 'DIAGNOSIS' in stay_row.index else "No diagnosis info",
+        'los': stay_row['LOS'],
+        'gender': stay_row['GENDER'],
+        'age': (admit_time - dob).days // 365,
+    }
+
+# Vital sign statistics of the events of a stay
+def stay_stats(events):
+    return events.groupby('LABEL', observed=True)['VALUE'].agg(['mean', 'median', 'std', 'min', 'max'])
+
+# Text line of one row of the vital sign statistics
+def stats_line(label, row):
+    return f"{label} - Mean: {row['mean']:.2f}, Median: {row['median']:.2f}, Std: {row['std']:.2f}, Min: {row['min']:.2f}, Max: {row['max']:.2f}"
+
+# Plot of the vital signs of a stay, every series is downsampled to max_points
+def stay_figure(stay, events, header, max_points=1400, downsample_method='minmax'):
+    fig = go.Figure()
+    grouped_stay_results = events.groupby('LABEL', observed=True)
+
+    for label, stay_values in grouped_stay_results:
+        x, y = downsample(charttimes(stay_values), stay_values['VALUE'].to_numpy(), max_points, downsample_method)
+        fig.add_trace(go.Scatter(x=x, y=y, mode='lines', name=label))
+
+    fig.update_layout(
+        title=f'Subject ID: {header["subject_id"]}, ICU Stay ID: {stay}<br>Diagnosis: {header["diagnosis"]}',
+        xaxis_title='Time',
+        yaxis_title='Value'
+    )
+    return fig
+
+# Write the PDF report of a stay: summary, statistics and range analysis, then the plot on its own page
+def write_stay_pdf(file_path, stay, header, stats, ranges, image=None):
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Arial", size=12)
+    pdf.cell(200, 10, txt="Patient ICU Stay Summary", ln=True, align='C')
+    pdf.ln(10)
+    pdf.cell(200, 10, txt=f"Subject ID: {header['subject_id']}", ln=True)
+    pdf.cell(200, 10, txt=f"ICU Stay ID: {stay}", ln=True)
+    pdf.cell(200, 10, txt=f"Diagnosis: {header['diagnosis']}", ln=True)
+    pdf.cell(200, 10, txt=f"Length of Stay (LOS): {header['los']:.2f} days", ln=True)
+    pdf.cell(200, 10, txt=f"Gender: {header['gender']}", ln=True)
+    pdf.cell(200, 10, txt=f"Age: {header['age']} years", ln=True)
+    pdf.ln(10)
+    pdf.cell(200, 10, txt="Vital Sign Statistics:", ln=True)
+    for label, row in stats.iterrows():
+        pdf.cell(200, 10, txt=stats_line(label, row), ln=True)
+    pdf.ln(10)
+    pdf.cell(200, 10, txt="Comparative Analysis with Normal Ranges:", ln=True)
+    for text in range_lines(ranges):
+        pdf.multi_cell(0, 10, txt=text)
+
+    if image is not None:
+        # FPDF only embeds images from files
+        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as f:
+            f.write(image)
+        try:
+            pdf.add_page()
+            pdf.cell(200, 10, txt="Vital Signs", ln=True, align='C')
+            pdf.image(f.name, x=10, w=190)
+        finally:
+            os.remove(f.name)
+
+    pdf.output(file_path)
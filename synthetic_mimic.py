@@ -0,0 +1,160 @@
+'''
+Deterministic synthetic MIMIC-III tables for local runs and benchmarks
+Writes CHARTEVENTS, ICUSTAYS, D_ITEMS, ADMISSIONS and PATIENTS .parquet files (the layout of datav7.py --data_dir)
+and the training_data / testing_data / chartevents inputs of train_test_csv_creation.py --input_dir.
+Stays have long tailed lengths of stay, are charted with either the CareVue or the MetaVision ITEMIDs of vital_items.py
+in hourly rounds, and the same seed and size always give the same tables, from 1k to millions of events
+'''
+
+# Imports
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from vital_items import item_ids, normal_ranges
+
+# Labels of the ITEMIDs in D_ITEMS, 40055 (urine output) has no normal range
+item_labels = {**{itemid: name for itemid, (name, low, high, unit) in normal_ranges.items()}, 40055: "Urine Out Foley"}
+item_units = {**{itemid: unit for itemid, (name, low, high, unit) in normal_ranges.items()}, 40055: "ml"}
+
+# Mean and standard deviation of the charted values, around the normal range of every vital sign
+item_values = {itemid: ((low + high) / 2, (high - low) / 2) for itemid, (name, low, high, unit) in normal_ranges.items()}
+item_values[40055] = (120, 60)
+
+# CareVue ITEMIDs (below 220000) and MetaVision ITEMIDs, a stay is charted with one of the two systems
+carevue_items = np.array([itemid for itemid in item_ids if itemid < 220000])
+metavision_items = np.array([itemid for itemid in item_ids if itemid >= 220000])
+
+diagnoses = ("SEPSIS", "PNEUMONIA", "CONGESTIVE HEART FAILURE", "CORONARY ARTERY DISEASE", "GASTROINTESTINAL BLEED",
+             "INTRACRANIAL HEMORRHAGE", "ACUTE RENAL FAILURE", "S/P FALL", "DIABETIC KETOACIDOSIS", "ALTERED MENTAL STATUS")
+
+# Stays with long tailed lengths of stay (log-normal, median about 2 days) until the chart events add up to n_events
+# Every stay is charted about events_per_hour times per hour, with at least a few events
+def synthetic_stays(n_events, rng, events_per_hour=4.0):
+    los, counts = [], []
+    total = 0
+    while total < n_events:
+        batch = max(16, int((n_events - total) / (events_per_hour * 24 * 3)))
+        batch_los = np.clip(rng.lognormal(np.log(2.0), 0.9, batch), 0.1, 120.0)
+        batch_counts = np.maximum(rng.poisson(batch_los * 24 * events_per_hour), 3)
+        los.append(batch_los)
+        counts.append(batch_counts)
+        total += batch_counts.sum()
+    los = np.concatenate(los)
+    counts = np.concatenate(counts)
+    n_stays = np.searchsorted(np.cumsum(counts), n_events) + 1
+    los, counts = los[:n_stays], counts[:n_stays]
+    counts[-1] -= counts.sum() - n_events
+    return np.round(los, 4), counts
+
+# Deterministic tables of about n_events chart events, returned as a dict of DataFrames
+def generate(n_events, seed=0, events_per_hour=4.0, error_rate=0.01):
+    rng = np.random.default_rng(seed)
+    los, counts = synthetic_stays(n_events, rng, events_per_hour)
+    n_stays = len(los)
+
+    # One to three stays per patient, every stay in its own admission
+    stays_per_patient = rng.choice([1, 1, 1, 2, 2, 3], size=n_stays)
+    subject_of_stay = np.repeat(np.arange(n_stays), stays_per_patient)[:n_stays]
+    n_patients = subject_of_stay[-1] + 1
+    subject_ids = np.arange(1, n_patients + 1)
+    icustay_ids = 200000 + np.arange(n_stays)
+    hadm_ids = 100000 + np.arange(n_stays)
+
+    dob = np.datetime64('2040-01-01', 'D') + rng.integers(0, 60 * 365, n_patients).astype('timedelta64[D]')
+    patients = pd.DataFrame({
+        'SUBJECT_ID': subject_ids,
+        'GENDER': rng.choice(['M', 'F'], n_patients),
+        'DOB': dob.astype('datetime64[us]'),
+    })
+    admit = (dob[subject_of_stay].astype('datetime64[m]')
+             + (rng.integers(18 * 365, 90 * 365, n_stays) * 24 * 60).astype('timedelta64[m]')
+             + rng.integers(0, 24 * 60, n_stays).astype('timedelta64[m]'))
+    admissions = pd.DataFrame({
+        'HADM_ID': hadm_ids,
+        'DIAGNOSIS': rng.choice(diagnoses, n_stays),
+        'ADMITTIME': admit.astype('datetime64[us]'),
+    })
+    icustays = pd.DataFrame({
+        'SUBJECT_ID': subject_ids[subject_of_stay],
+        'HADM_ID': hadm_ids,
+        'ICUSTAY_ID': icustay_ids,
+        'LOS': los,
+    })
+    d_items = pd.DataFrame({'ITEMID': list(item_ids), 'LABEL': [item_labels[itemid] for itemid in item_ids]})
+
+    # Chart events: every event is charted in an hourly round (most) or at a random minute of the stay
+    stay = np.repeat(np.arange(n_stays), counts)
+    los_minutes = np.maximum((los * 24 * 60).astype(np.int64), 1)[stay]
+    minute = (rng.random(len(stay)) * los_minutes).astype(np.int64)
+    on_round = rng.random(len(stay)) < 0.7
+    minute[on_round] -= minute[on_round] % 60
+    start = admit + rng.integers(0, 6 * 60, n_stays).astype('timedelta64[m]')
+    charttime = start[stay] + minute.astype('timedelta64[m]')
+
+    metavision = rng.random(n_stays) < 0.6
+    item_choice = rng.integers(0, 1 << 30, len(stay))
+    itemid = np.where(metavision[stay], metavision_items[item_choice % len(metavision_items)],
+                      carevue_items[item_choice % len(carevue_items)])
+    keys = np.array(sorted(item_values))
+    position = np.searchsorted(keys, itemid)
+    means = np.array([item_values[key][0] for key in keys])[position]
+    stds = np.array([item_values[key][1] for key in keys])[position]
+    # Every stay is a bit above or below the normal values, so the stays differ in time in range
+    stay_shift = rng.normal(0, 0.5, n_stays)[stay]
+    value = means + stds * (stay_shift + rng.normal(0, 0.8, len(stay)))
+    value = np.round(np.maximum(value, 0), 1)
+
+    chartevents = pd.DataFrame({
+        'SUBJECT_ID': icustays['SUBJECT_ID'].to_numpy()[stay],
+        'ICUSTAY_ID': icustay_ids[stay],
+        'ITEMID': itemid,
+        'VALUE': value.astype(str),
+        'VALUEUOM': pd.Series(itemid).map(item_units).to_numpy(),
+        'CHARTTIME': pd.to_datetime(charttime.astype('datetime64[us]')).tz_localize('UTC'),
+        'ERROR': (rng.random(len(stay)) < error_rate).astype(np.int64),
+    })
+    # Exports are not sorted
+    chartevents = chartevents.iloc[rng.permutation(len(chartevents))].reset_index(drop=True)
+    return {
+        'CHARTEVENTS': chartevents,
+        'ICUSTAYS': icustays,
+        'D_ITEMS': d_items,
+        'ADMISSIONS': admissions,
+        'PATIENTS': patients,
+    }
+
+# Inputs of train_test_csv_creation.py: the clean chart events with the LOS of their stay,
+# split into training and testing on ICUSTAY_ID like --split_mode hash
+def pipeline_inputs(tables, test_fraction=0.2):
+    from train_test_csv_creation import hash_split
+
+    events = tables['CHARTEVENTS']
+    events = events[events['ERROR'] == 0].merge(tables['ICUSTAYS'][['ICUSTAY_ID', 'LOS']], on='ICUSTAY_ID')
+    clean = events[['ICUSTAY_ID', 'ITEMID', 'VALUE', 'CHARTTIME', 'LOS']].reset_index(drop=True)
+    testing = [icustay_id for icustay_id in clean['ICUSTAY_ID'].unique() if hash_split(icustay_id, test_fraction) == 'testing']
+    split = np.where(clean['ICUSTAY_ID'].isin(testing), 'testing', 'training')
+    return {
+        'chartevents': clean,
+        'training_data': clean[split == 'training'].reset_index(drop=True),
+        'testing_data': clean[split == 'testing'].reset_index(drop=True),
+    }
+
+# Write the MIMIC tables and the pipeline inputs of about n_events chart events to output_dir
+def write_fixtures(output_dir, n_events, seed=0):
+    os.makedirs(output_dir, exist_ok=True)
+    tables = generate(n_events, seed)
+    for name, table in {**tables, **pipeline_inputs(tables)}.items():
+        table.to_parquet(f'{output_dir}/{name}.parquet', index=False)
+    return tables
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', default='mimic')
+    parser.add_argument('--events', type=int, default=100000, help='Number of chart events')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    tables = write_fixtures(args.output_dir, args.events, args.seed)
+    print(f"{len(tables['CHARTEVENTS'])} chart events, {len(tables['ICUSTAYS'])} ICU stays, "
+          f"{len(tables['PATIENTS'])} patients written to {args.output_dir}")
@@ -1,36 +1,197 @@
+import argparse
+import hashlib
+import json
+import math
+import zlib
 import apache_beam as beam
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from apache_beam.metrics import Metrics
+from apache_beam.metrics.metric import MetricsFilter
 from apache_beam.options.pipeline_options import PipelineOptions
 from apache_beam.io.gcp.bigquery import ReadFromBigQuery
 import datetime
+from vital_items import item_ids
+from stay_manifest import load_manifest, save_manifest, merge_run
+
+# Namespace of the pipeline metrics, reported at the end of run_pipeline
+metrics_namespace = 'icustay'
 
 # Process elements from the input data.
 class PrepareData(beam.DoFn):
+    def __init__(self):
+        self.events = Metrics.counter(metrics_namespace, 'events')
+
     def process(self, element):
+        self.events.inc()
         return [(element['ICUSTAY_ID'], (element['ITEMID'], element['VALUE'], element['CHARTTIME'], element['LOS']))]
 
+# Parse a CHARTTIME string into a datetime, datetimes are returned unchanged
+def parse_charttime(charttime):
+    if isinstance(charttime, str):
+        return datetime.datetime.strptime(charttime, "%Y-%m-%d %H:%M:%S%z")
+    return charttime
+
+# Collect the measures of a stay in a single list and sort them once by CHARTTIME
+class CollectMeasures(beam.CombineFn):
+    def __init__(self, sort=True):
+        self.sort = sort
+
+    def create_accumulator(self):
+        return []
+
+    def add_input(self, accumulator, measure):
+        accumulator.append(measure)
+        return accumulator
+
+    def merge_accumulators(self, accumulators):
+        accumulators = iter(accumulators)
+        merged = next(accumulators)
+        for accumulator in accumulators:
+            merged.extend(accumulator)
+        return merged
+
+    def extract_output(self, accumulator):
+        if not self.sort:
+            return accumulator
+        # Parse every CHARTTIME once, so sorting and ConsolidateMeasures compare datetimes
+        measures = [(itemid, value, parse_charttime(charttime), los) for itemid, value, charttime, los in accumulator]
+        measures.sort(key=lambda x: x[2])
+        return measures
+
+# Deterministic split of an ICU stay, the same ICUSTAY_ID always lands in the same split
+def hash_split(icustay_id, test_fraction):
+    bucket = zlib.crc32(str(icustay_id).encode()) % 10000
+    return 'testing' if bucket < test_fraction * 10000 else 'training'
+
+# Key every measure by (split, ICUSTAY_ID), the split is either fixed by the source or hashed
+class AssignSplit(beam.DoFn):
+    def __init__(self, split=None, test_fraction=0.2):
+        self.split = split
+        self.test_fraction = test_fraction
+
+    def process(self, element):
+        icustay_id, measure = element
+        split = self.split or hash_split(icustay_id, self.test_fraction)
+        yield ((split, icustay_id), measure)
+
+# Send every stay to the tagged output of its split and drop the split from the key
+class SplitStays(beam.DoFn):
+    def process(self, element):
+        (split, icustay_id), *rest = element
+        yield beam.pvalue.TaggedOutput(split, (icustay_id, *rest))
+
+# Fingerprint of a stay: number of measures, order independent content hash and max CHARTTIME
+class StayFingerprint(beam.CombineFn):
+    def create_accumulator(self):
+        return (0, 0, None)
+
+    def add_input(self, accumulator, measure):
+        count, digest, max_time = accumulator
+        itemid, value, charttime, los = measure
+        charttime = parse_charttime(charttime)
+        content = repr((itemid, value, charttime.isoformat(), los)).encode()
+        digest += int.from_bytes(hashlib.blake2b(content, digest_size=8).digest(), 'little')
+        max_time = charttime if max_time is None else max(max_time, charttime)
+        return (count + 1, digest % 2**64, max_time)
+
+    def merge_accumulators(self, accumulators):
+        count, digest, max_time = 0, 0, None
+        for other_count, other_digest, other_time in accumulators:
+            count += other_count
+            digest = (digest + other_digest) % 2**64
+            if other_time is not None:
+                max_time = other_time if max_time is None else max(max_time, other_time)
+        return (count, digest, max_time)
+
+    def extract_output(self, accumulator):
+        count, digest, max_time = accumulator
+        return {'events': count, 'hash': f'{digest:016x}', 'max_charttime': max_time.isoformat()}
+
+# Whether a fingerprinted stay is new or differs from its manifest entry
+def is_changed(element, known):
+    (split, icustay_id), fingerprint = element
+    return known.get((split, int(icustay_id))) != fingerprint['hash']
+
+# Manifest entry of a reprocessed stay, written as one JSON line
+def format_fingerprint(element):
+    (split, icustay_id), fingerprint = element
+    return json.dumps({'split': split, 'icustay_id': int(icustay_id), **fingerprint})
+
 # Consolidate measures by integer timestamp
 class ConsolidateMeasures(beam.DoFn):
+    def __init__(self):
+        self.events_per_stay = Metrics.distribution(metrics_namespace, 'events_per_stay')
+        self.minute_buckets_per_stay = Metrics.distribution(metrics_namespace, 'minute_buckets_per_stay')
+
     def process(self, element):
         icustay_id, measures = element
         consolidated = {}
         
-        # Ensure the first CHARTTIME is a string before converting to datetime
-        start_time = measures[0][2]
-        if isinstance(start_time, str):
-            start_time = datetime.datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S%z")
+        # Ensure the first CHARTTIME is a datetime object
+        start_time = parse_charttime(measures[0][2])
         
         for itemid, value, charttime, los in measures:
             # Ensure CHARTTIME is a datetime object before calculating time difference
-            if isinstance(charttime, str):
-                charttime = datetime.datetime.strptime(charttime, "%Y-%m-%d %H:%M:%S%z")
+            charttime = parse_charttime(charttime)
             time_diff = int((charttime - start_time).total_seconds() / 60)  # Minutes since start_time
             if time_diff not in consolidated:
                 consolidated[time_diff] = []
             consolidated[time_diff].append((itemid, value))
+        self.events_per_stay.update(len(measures))
+        self.minute_buckets_per_stay.update(len(consolidated))
         yield (icustay_id, consolidated, los)
 
+# Consolidate the measures of a stay into a dense time step x ITEMID float32 matrix
+# Missing measures are NaN, the mask marks the observed ones
+class ConsolidateTensor(beam.DoFn):
+    def __init__(self, item_ids=item_ids):
+        self.item_ids = item_ids
+        self.events_per_stay = Metrics.distribution(metrics_namespace, 'events_per_stay')
+        self.minute_buckets_per_stay = Metrics.distribution(metrics_namespace, 'minute_buckets_per_stay')
+        self.unknown_itemids = Metrics.counter(metrics_namespace, 'unknown_itemids')
+
+    def setup(self):
+        self.vocabulary = np.asarray(self.item_ids, dtype=np.int64)
+        self.order = np.argsort(self.vocabulary)
+
+    def process(self, element):
+        icustay_id, measures = element
+        itemids, values, charttimes, los = zip(*measures)
+
+        # Parse every CHARTTIME of the stay in one call and sort by it
+        times = pd.to_datetime(list(charttimes), utc=True).tz_localize(None).to_numpy(dtype='datetime64[s]').astype(np.int64)
+        order = np.argsort(times, kind='stable')
+        times = times[order]
+        itemids = np.asarray(itemids, dtype=np.int64)[order]
+        values = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=np.float32)[order]
+
+        # Map ITEMIDs to their column in item_ids, unknown ITEMIDs are dropped
+        position = np.searchsorted(self.vocabulary, itemids, sorter=self.order)
+        position = np.minimum(position, len(self.vocabulary) - 1)
+        columns = self.order[position]
+        known = self.vocabulary[columns] == itemids
+
+        # One row per distinct minute since the first CHARTTIME, the last value of a minute wins
+        minutes = ((times - times[0]) // 60).astype(np.int32)
+        steps, rows = np.unique(minutes[known], return_inverse=True)
+        matrix = np.full((len(steps), len(self.vocabulary)), np.nan, dtype=np.float32)
+        matrix[rows, columns[known]] = values[known]
+        self.events_per_stay.update(len(measures))
+        self.minute_buckets_per_stay.update(len(steps))
+        self.unknown_itemids.inc(int(len(known) - known.sum()))
+        yield (icustay_id, steps, matrix, ~np.isnan(matrix), los[0])
+
+# Size of the formatted sequence of every stay, in bytes
+def sequence_bytes():
+    return Metrics.distribution(metrics_namespace, 'sequence_bytes')
+
 # Format the output
 class FormatOutput(beam.DoFn):
+    def __init__(self):
+        self.sequence_bytes = sequence_bytes()
+
     def process(self, element):
         icustay_id, consolidated, los = element
         sequences = []
@@ -38,26 +199,327 @@ class FormatOutput(beam.DoFn):
             measures_str = ",".join([f"({itemid},{value})" for itemid, value in measures])
             sequences.append(f"[{time_diff},{measures_str}]")
         padded_sequence = "[" + ",".join(sequences) + "]"
-        yield f'{icustay_id},"{padded_sequence}",{los}'
+        line = f'{icustay_id},"{padded_sequence}",{los}'
+        self.sequence_bytes.update(len(line))
+        yield line
 
-# Padding
-class PadSequences(beam.DoFn):
-    def process(self, element, max_length=143210):
-        icustay_id, padded_sequence, los = element
-        if len(padded_sequence) > max_length:
-            padded_sequence = padded_sequence[:max_length]
-        yield (icustay_id, padded_sequence, los)
+# Convert a chart VALUE to float, non numeric values become NaN
+def parse_value(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
 
-# Pipeline options
-options = PipelineOptions(
-    project='cdla-trabalho',
-    runner='DataflowRunner',
-    region='us-central1',
-    staging_location='gs://events_trabalho_cdle/staging',
-    temp_location='gs://events_trabalho_cdle/temp',
-    save_main_session=True
+# Format the output as one columnar row per stay with flat typed arrays
+class FormatColumnar(beam.DoFn):
+    def __init__(self):
+        self.sequence_bytes = sequence_bytes()
+
+    def process(self, element):
+        icustay_id, consolidated, los = element
+        minutes, itemids, values = [], [], []
+        for time_diff, measures in consolidated.items():
+            for itemid, value in measures:
+                minutes.append(time_diff)
+                itemids.append(int(itemid))
+                values.append(parse_value(value))
+        # int32 MINUTE and ITEMID, float32 VALUE
+        self.sequence_bytes.update(12 * len(minutes))
+        yield {
+            'ICUSTAY_ID': int(icustay_id),
+            'LOS': float(los),
+            'MINUTE': minutes,
+            'ITEMID': itemids,
+            'VALUE': values,
+        }
+
+# Single pass, mergeable moment accumulators of the vital sign values of a stay, behind StayFeatures
+# They replace the extract_features step of the RF and CatBoost notebooks without parsing the sequences,
+# and live in this file like every other stage so the pipeline workers need no other local module
+
+# Feature names, in the order of the notebooks
+FEATURE_NAMES = ('mean', 'std', 'max', 'min', 'length', 'unique', 'variance', 'skewness', 'kurtosis')
+
+# Empty accumulator: count, mean, M2, M3, M4 (sums of the powers of the deviations), min, max, distinct values
+def create_moments():
+    return [0, 0.0, 0.0, 0.0, 0.0, math.inf, -math.inf, set()]
+
+# Add one value to an accumulator in place
+def add_value(moments, x):
+    n1, mean, m2, m3, m4 = moments[:5]
+    n = n1 + 1
+    delta = x - mean
+    delta_n = delta / n
+    delta_n2 = delta_n * delta_n
+    term = delta * delta_n * n1
+    moments[0] = n
+    moments[1] = mean + delta_n
+    moments[4] = m4 + term * delta_n2 * (n * n - 3 * n + 3) + 6 * delta_n2 * m2 - 4 * delta_n * m3
+    moments[3] = m3 + term * delta_n * (n - 2) - 3 * delta_n * m2
+    moments[2] = m2 + term
+    moments[5] = min(moments[5], x)
+    moments[6] = max(moments[6], x)
+    moments[7].add(x)
+    return moments
+
+# Merge accumulator b into a in place, the pairwise update keeps the result independent of how values were split
+def merge_moments(a, b):
+    na, nb = a[0], b[0]
+    if nb == 0:
+        return a
+    if na == 0:
+        a[:7] = b[:7]
+        a[7] = set(b[7])
+        return a
+    n = na + nb
+    delta = b[1] - a[1]
+    delta2 = delta * delta
+    m2 = a[2] + b[2] + delta2 * na * nb / n
+    m3 = (a[3] + b[3] + delta2 * delta * na * nb * (na - nb) / n ** 2
+          + 3 * delta * (na * b[2] - nb * a[2]) / n)
+    m4 = (a[4] + b[4] + delta2 * delta2 * na * nb * (na * na - na * nb + nb * nb) / n ** 3
+          + 6 * delta2 * (na * na * b[2] + nb * nb * a[2]) / n ** 2
+          + 4 * delta * (na * b[3] - nb * a[3]) / n)
+    a[:5] = [n, a[1] + delta * nb / n, m2, m3, m4]
+    a[5] = min(a[5], b[5])
+    a[6] = max(a[6], b[6])
+    a[7] |= b[7]
+    return a
+
+# Features of an accumulator, std and variance are population ones (np.std, np.var),
+# skewness and kurtosis are the bias corrected ones of pandas: NaN below 3 (skewness) and 4 (kurtosis) values
+# and 0 for constant values. Without any value every feature is 0 like in the notebooks
+def moment_features(moments):
+    n, mean, m2, m3, m4, low, high, values = moments
+    if n == 0:
+        return dict.fromkeys(FEATURE_NAMES, 0)
+    variance = m2 / n
+    skewness = kurtosis = math.nan
+    if n >= 3:
+        skewness = math.sqrt(n * (n - 1)) / (n - 2) * math.sqrt(n) * m3 / m2 ** 1.5 if m2 > 0 else 0.0
+    if n >= 4:
+        kurtosis = (n - 1) / ((n - 2) * (n - 3)) * ((n + 1) * (n * m4 / (m2 * m2) - 3) + 6) if m2 > 0 else 0.0
+    return {
+        'mean': mean,
+        'std': math.sqrt(variance),
+        'max': high,
+        'min': low,
+        'length': n,
+        'unique': len(values),
+        'variance': variance,
+        'skewness': skewness,
+        'kurtosis': kurtosis,
+    }
+
+# Column names of the feature table: the features of all values, then the features of every ITEMID
+def feature_columns(item_ids):
+    return list(FEATURE_NAMES) + [f'{itemid}_{name}' for itemid in item_ids for name in FEATURE_NAMES]
+
+# Features of a stay computed in a single pass over its measures: the features of all values and of every ITEMID
+# The accumulator is (LOS, moments of all values, moments per ITEMID), values that are not numeric are skipped
+class StayFeatures(beam.CombineFn):
+    def __init__(self, item_ids=item_ids):
+        self.item_ids = item_ids
+
+    def create_accumulator(self):
+        return [None, create_moments(), {}]
+
+    def add_input(self, accumulator, measure):
+        itemid, value, charttime, los = measure
+        accumulator[0] = los
+        value = parse_value(value)
+        if not math.isnan(value):
+            add_value(accumulator[1], value)
+            itemid = int(itemid)
+            if itemid not in accumulator[2]:
+                accumulator[2][itemid] = create_moments()
+            add_value(accumulator[2][itemid], value)
+        return accumulator
+
+    def merge_accumulators(self, accumulators):
+        accumulators = iter(accumulators)
+        merged = next(accumulators)
+        for los, moments, items in accumulators:
+            if merged[0] is None:
+                merged[0] = los
+            merge_moments(merged[1], moments)
+            for itemid, item_moments in items.items():
+                if itemid in merged[2]:
+                    merge_moments(merged[2][itemid], item_moments)
+                else:
+                    merged[2][itemid] = item_moments
+        return merged
+
+    def extract_output(self, accumulator):
+        los, moments, items = accumulator
+        features = {'LOS': float(los), **moment_features(moments)}
+        for itemid in self.item_ids:
+            item_features = moment_features(items.get(itemid, create_moments()))
+            for name in FEATURE_NAMES:
+                features[f'{itemid}_{name}'] = item_features[name]
+        return features
+
+# Format the features of a stay as one row of the feature table
+class FormatFeatures(beam.DoFn):
+    def process(self, element):
+        icustay_id, features = element
+        yield {'ICUSTAY_ID': int(icustay_id), **features}
+
+# Format the dense tensor of a stay as one columnar row, the matrix and its mask are flattened row major
+class FormatTensor(beam.DoFn):
+    def __init__(self):
+        self.sequence_bytes = sequence_bytes()
+
+    def process(self, element):
+        icustay_id, steps, matrix, mask, los = element
+        # int32 MINUTE, float32 VALUES and the bit packed MASK
+        self.sequence_bytes.update(4 * (len(steps) + matrix.size) + -(-mask.size // 8))
+        yield {
+            'ICUSTAY_ID': int(icustay_id),
+            'LOS': float(los),
+            'MINUTE': steps.tolist(),
+            'VALUES': matrix.ravel().tolist(),
+            'MASK': mask.ravel().tolist(),
+        }
+
+# Counters of the stays cut by a window and of the minute buckets they lost
+def truncation_metrics():
+    return Metrics.counter(metrics_namespace, 'truncated_stays'), Metrics.distribution(metrics_namespace, 'dropped_steps')
+
+# Bound a consolidated stay to its first horizon_hours and/or first max_steps minute buckets
+# Whole minute buckets are kept or dropped, so every row stays parseable
+class WindowSequences(beam.DoFn):
+    def __init__(self, horizon_hours=None, max_steps=None):
+        self.horizon_hours = horizon_hours
+        self.max_steps = max_steps
+        self.truncated_stays, self.dropped_steps = truncation_metrics()
+
+    def process(self, element):
+        icustay_id, consolidated, los = element
+        windowed = {}
+        for time_diff, measures in consolidated.items():
+            if self.horizon_hours is not None and time_diff >= self.horizon_hours * 60:
+                break
+            if self.max_steps is not None and len(windowed) >= self.max_steps:
+                break
+            windowed[time_diff] = measures
+        if len(windowed) < len(consolidated):
+            self.truncated_stays.inc()
+            self.dropped_steps.update(len(consolidated) - len(windowed))
+        yield (icustay_id, windowed, los)
+
+# Carry the last observed value of every column forward in time, leading gaps stay NaN
+def forward_fill(matrix):
+    rows = np.where(~np.isnan(matrix), np.arange(len(matrix))[:, None], 0)
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    return matrix[rows, np.arange(matrix.shape[1])]
+
+# Bound a stay tensor by time horizon and/or number of time steps
+# With interval_minutes the stay is resampled onto a regular grid (last value per interval),
+# so horizon_hours and interval_minutes together give every stay the same number of rows
+class WindowTensor(beam.DoFn):
+    def __init__(self, horizon_hours=None, max_steps=None, interval_minutes=None, forward_fill=False):
+        self.horizon_hours = horizon_hours
+        self.max_steps = max_steps
+        self.interval_minutes = interval_minutes
+        self.forward_fill = forward_fill
+        self.truncated_stays, self.dropped_steps = truncation_metrics()
+
+    def process(self, element):
+        icustay_id, steps, matrix, mask, los = element
+        dropped = 0
+
+        if self.horizon_hours is not None:
+            keep = steps < self.horizon_hours * 60
+            dropped += len(steps) - int(keep.sum())
+            steps, matrix = steps[keep], matrix[keep]
+
+        if self.interval_minutes is not None:
+            buckets = steps // self.interval_minutes
+            if self.horizon_hours is not None:
+                n_buckets = -(-self.horizon_hours * 60 // self.interval_minutes)
+            else:
+                n_buckets = int(buckets[-1]) + 1 if len(buckets) else 0
+            resampled = np.full((n_buckets, matrix.shape[1]), np.nan, dtype=np.float32)
+            rows, columns = np.nonzero(~np.isnan(matrix))
+            resampled[buckets[rows], columns] = matrix[rows, columns]
+            steps = (np.arange(n_buckets) * self.interval_minutes).astype(np.int32)
+            matrix = resampled
+
+        if self.max_steps is not None:
+            dropped += max(len(steps) - self.max_steps, 0)
+            steps, matrix = steps[:self.max_steps], matrix[:self.max_steps]
+
+        # Resampled stays count the grid rows dropped by max_steps
+        if dropped:
+            self.truncated_stays.inc()
+            self.dropped_steps.update(dropped)
+
+        # The mask keeps marking the measured values only, not the forward filled ones
+        mask = ~np.isnan(matrix)
+        if self.forward_fill:
+            matrix = forward_fill(matrix)
+        yield (icustay_id, steps, matrix, mask, los)
+
+# Schema of the columnar output, read back by sequence_reader.py
+SEQUENCE_SCHEMA = pa.schema([
+    ('ICUSTAY_ID', pa.int64()),
+    ('LOS', pa.float64()),
+    ('MINUTE', pa.list_(pa.int32())),
+    ('ITEMID', pa.list_(pa.int32())),
+    ('VALUE', pa.list_(pa.float32())),
+])
+
+# Schema of the dense tensor output, VALUES holds len(MINUTE) x len(item_ids) floats
+# and MASK marks the measured ones, so forward filled values are not mistaken for measures
+TENSOR_SCHEMA = pa.schema([
+    ('ICUSTAY_ID', pa.int64()),
+    ('LOS', pa.float64()),
+    ('MINUTE', pa.list_(pa.int32())),
+    ('VALUES', pa.list_(pa.float32())),
+    ('MASK', pa.list_(pa.bool_())),
+])
+
+# Schema of the feature table, one row per stay with the features of all values and of every ITEMID
+FEATURE_SCHEMA = pa.schema(
+    [('ICUSTAY_ID', pa.int64()), ('LOS', pa.float64())]
+    + [(column, pa.int64() if column.endswith(('length', 'unique')) else pa.float64()) for column in feature_columns(item_ids)]
 )
 
+# Command line arguments, the defaults reproduce the original Dataflow run
+parser = argparse.ArgumentParser()
+parser.add_argument('--runner', default='DataflowRunner')
+parser.add_argument('--output_format', choices=['csv', 'parquet', 'tensor'], default='csv')
+parser.add_argument('--output_dir', default='gs://events_trabalho_cdle')
+parser.add_argument('--horizon_hours', type=int, default=None, help='Keep only the first hours of every stay')
+parser.add_argument('--max_steps', type=int, default=None, help='Keep only the first time steps of every stay')
+parser.add_argument('--interval_minutes', type=int, default=None, help='Resample tensors to a fixed interval')
+parser.add_argument('--forward_fill', action='store_true', help='Forward fill resampled tensors')
+parser.add_argument('--split_mode', choices=['tables', 'hash'], default='tables',
+                    help='tables reads training_data and testing_data, hash splits one source on ICUSTAY_ID')
+parser.add_argument('--test_fraction', type=float, default=0.2, help='Fraction of stays sent to testing with --split_mode hash')
+parser.add_argument('--incremental', action='store_true',
+                    help='Only reprocess stays that are new or changed since the last run (parquet and tensor formats)')
+parser.add_argument('--manifest', default=None, help='Manifest used by --incremental, defaults to <output_dir>/manifest.json')
+parser.add_argument('--features', action='store_true',
+                    help='Also write the per stay feature table of the tabular models to <output_dir>/features_<split>')
+parser.add_argument('--input_dir', default=None,
+                    help='Read local training_data*/testing_data*.parquet (or chartevents*.parquet with --split_mode hash) instead of BigQuery')
+
+# Pipeline options
+def build_options(runner, beam_args):
+    if runner == 'DataflowRunner':
+        return PipelineOptions(
+            beam_args,
+            project='cdla-trabalho',
+            runner='DataflowRunner',
+            region='us-central1',
+            staging_location='gs://events_trabalho_cdle/staging',
+            temp_location='gs://events_trabalho_cdle/temp',
+            save_main_session=True
+        )
+    return PipelineOptions(beam_args, runner=runner)
+
 # Query for training data
 training_query = """
 SELECT *
@@ -70,24 +532,134 @@ SELECT *
 FROM `CHARTEVENTS.testing_data`
 """
 
-# Function to create pipeline
-def run_pipeline(query, output_prefix):
-    with beam.Pipeline(options=options) as p:
+# Query for the whole clean data, split by hash on ICUSTAY_ID
+all_query = """
+SELECT *
+FROM `CHARTEVENTS.CHARTEVENTS_CLEAN`
+"""
+
+# Splits written by the pipeline
+splits = ('training', 'testing')
+
+# Read either from BigQuery or from local Parquet files
+def read_source(p, name, query, input_pattern=None):
+    if input_pattern:
+        return p | f'Read {name} from Parquet' >> beam.io.ReadFromParquet(input_pattern)
+    return p | f'Read {name} from BigQuery' >> ReadFromBigQuery(query=query, use_standard_sql=True)
+
+# Read the measures of every stay keyed by (split, ICUSTAY_ID)
+def read_measures(p, args):
+    if args.split_mode == 'hash':
+        input_pattern = f'{args.input_dir}/chartevents*.parquet' if args.input_dir else None
+        return (read_source(p, 'chartevents', all_query, input_pattern)
+                | 'PrepareData' >> beam.ParDo(PrepareData())
+                | 'AssignSplit' >> beam.ParDo(AssignSplit(test_fraction=args.test_fraction)))
+
+    measures = []
+    for split, query in zip(splits, (training_query, test_query)):
+        input_pattern = f'{args.input_dir}/{split}_data*.parquet' if args.input_dir else None
+        measures.append(read_source(p, split, query, input_pattern)
+                        | f'PrepareData {split}' >> beam.ParDo(PrepareData())
+                        | f'AssignSplit {split}' >> beam.ParDo(AssignSplit(split)))
+    return measures | 'Flatten splits' >> beam.Flatten()
+
+# Format and write the stays of one split, incremental runs write new shards tagged with the run id
+def write_split(stays, split, args, run_id=None):
+    prefix = f'{args.output_dir}/{split}-{run_id}' if run_id else f'{args.output_dir}/{split}'
+    if args.output_format == 'tensor':
+        (stays
+         | f'FormatTensor {split}' >> beam.ParDo(FormatTensor())
+         | f'Write {split} to Parquet' >> beam.io.WriteToParquet(prefix, TENSOR_SCHEMA, file_name_suffix='.parquet'))
+    elif args.output_format == 'parquet':
+        (stays
+         | f'FormatColumnar {split}' >> beam.ParDo(FormatColumnar())
+         | f'Write {split} to Parquet' >> beam.io.WriteToParquet(prefix, SEQUENCE_SCHEMA, file_name_suffix='.parquet'))
+    else:
         header = 'ICUSTAY_ID,Padded_Sequence,LOS'
-        
-        (p
-         | 'Read from BigQuery' >> ReadFromBigQuery(query=query, use_standard_sql=True)
-         | 'PrepareData' >> beam.ParDo(PrepareData())
-         | 'FormatData' >> beam.Map(lambda element: (element[0], [element[1]]))
-         | 'CombinePerKey' >> beam.CombinePerKey(lambda values: sum(values, []))
-         | 'SortValues' >> beam.Map(lambda kv: (kv[0], sorted(kv[1], key=lambda x: x[2])))  # Sort values by CHARTTIME
-         | 'ConsolidateMeasures' >> beam.ParDo(ConsolidateMeasures())
-         | 'PadSequences' >> beam.ParDo(PadSequences())
-         | 'FormatOutput' >> beam.ParDo(FormatOutput())
-         | 'Write to Text' >> beam.io.WriteToText(f'gs://events_trabalho_cdle/{output_prefix}', file_name_suffix='.csv', header=header, shard_name_template=''))
-
-# Run pipeline for training data
-run_pipeline(training_query, 'training')
-
-# Run pipeline for test data
-run_pipeline(test_query, 'testing')
+        (stays
+         | f'FormatOutput {split}' >> beam.ParDo(FormatOutput())
+         | f'Write {split} to Text' >> beam.io.WriteToText(prefix, file_name_suffix='.csv', header=header, shard_name_template=''))
+
+# Write the feature table of one split
+def write_features(features, split, args, run_id=None):
+    prefix = f'{args.output_dir}/features_{split}-{run_id}' if run_id else f'{args.output_dir}/features_{split}'
+    (features
+     | f'FormatFeatures {split}' >> beam.ParDo(FormatFeatures())
+     | f'Write {split} features to Parquet' >> beam.io.WriteToParquet(prefix, FEATURE_SCHEMA, file_name_suffix='.parquet'))
+
+# Print the counters and distributions of the pipeline, runners without metrics support are skipped
+def report_metrics(result):
+    try:
+        metrics = result.metrics().query(MetricsFilter().with_namespace(metrics_namespace))
+    except (AttributeError, NotImplementedError):
+        return
+    # One result per metric and step, e.g. sequence_bytes of the training and of the testing writes
+    for counter in sorted(metrics['counters'], key=lambda m: (m.key.metric.name, m.key.step)):
+        print(f'{counter.key.metric.name} ({counter.key.step}): {counter.committed}')
+    for distribution in sorted(metrics['distributions'], key=lambda m: (m.key.metric.name, m.key.step)):
+        value = distribution.committed
+        if value is not None and value.count:
+            print(f'{distribution.key.metric.name} ({distribution.key.step}): {value.count} stays, min {value.min}, '
+                  f'mean {value.mean:.1f}, max {value.max}, total {value.sum}')
+
+# Function to create the pipeline, both splits go through the shared transforms once
+def run_pipeline(args, beam_args):
+    run_id = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%d%H%M%S') if args.incremental else None
+    manifest_path = args.manifest or f'{args.output_dir}/manifest.json'
+    manifest = load_manifest(manifest_path) if args.incremental else {}
+
+    with beam.Pipeline(options=build_options(args.runner, beam_args)) as p:
+        measures = read_measures(p, args)
+
+        if args.incremental:
+            # Keep only the measures of stays whose fingerprint is not in the manifest
+            known = {key: entry['hash'] for key, entry in manifest.items()}
+            changed = (measures
+             | 'StayFingerprint' >> beam.CombinePerKey(StayFingerprint())
+             | 'KeepChanged' >> beam.Filter(is_changed, known))
+            (changed
+             | 'FormatFingerprint' >> beam.Map(format_fingerprint)
+             | 'Write fingerprints' >> beam.io.WriteToText(f'{args.output_dir}/_fingerprints-{run_id}', file_name_suffix='.jsonl'))
+            measures = measures | 'FilterChanged' >> beam.Filter(lambda kv, changed: kv[0] in changed, changed=beam.pvalue.AsDict(changed))
+
+        if args.output_format == 'tensor':
+            # ConsolidateTensor parses and sorts the CHARTTIMEs itself
+            stays = (measures
+             | 'CollectMeasures' >> beam.CombinePerKey(CollectMeasures(sort=False))
+             | 'ConsolidateTensor' >> beam.ParDo(ConsolidateTensor())
+             | 'WindowTensor' >> beam.ParDo(WindowTensor(args.horizon_hours, args.max_steps, args.interval_minutes, args.forward_fill)))
+        else:
+            stays = (measures
+             | 'CollectMeasures' >> beam.CombinePerKey(CollectMeasures())  # Sorted by CHARTTIME
+             | 'ConsolidateMeasures' >> beam.ParDo(ConsolidateMeasures())
+             | 'WindowSequences' >> beam.ParDo(WindowSequences(args.horizon_hours, args.max_steps)))
+
+        split_stays = stays | 'SplitStays' >> beam.ParDo(SplitStays()).with_outputs(*splits)
+        for split in splits:
+            write_split(split_stays[split], split, args, run_id)
+
+        if args.features:
+            # Computed from the raw measures of the whole stay, independent of the sequence format and windowing
+            features = (measures
+             | 'StayFeatures' >> beam.CombinePerKey(StayFeatures())
+             | 'SplitFeatures' >> beam.ParDo(SplitStays()).with_outputs(*splits))
+            for split in splits:
+                write_features(features[split], split, args, run_id)
+
+    report_metrics(p.result)
+
+    if args.incremental:
+        outputs = {'file': '{split}', 'features_file': 'features_{split}'} if args.features else {'file': '{split}'}
+        reprocessed, rewritten = merge_run(manifest, args.output_dir, run_id, splits, outputs)
+        save_manifest(manifest_path, manifest)
+        print(f'Reprocessed {reprocessed} stays, rewrote {rewritten} existing shards')
+
+if __name__ == '__main__':
+    args, beam_args = parser.parse_known_args()
+    if args.incremental and args.output_format == 'csv':
+        parser.error('--incremental needs --output_format parquet or tensor')
+    if args.output_format != 'tensor' and (args.interval_minutes is not None or args.forward_fill):
+        parser.error('--interval_minutes and --forward_fill need --output_format tensor')
+
+    # Run a single pipeline for training and test data
+    run_pipeline(args, beam_args)
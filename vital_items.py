@@ -0,0 +1,38 @@
+'''
+ITEMIDs shared by the visualization app and the preprocessing pipeline
+'''
+
+# Define the ITEMIDs for the desired attributes (Heart Rate, O2 Percentage, Respiration Rate, etc.) 
+item_ids = (211, 220045, 51, 220179, 8368, 220180, 52, 220181, 618, 220210, 646, 220277, 678, 223761, 113, 220074, 807, 220621, 40055)
+
+# Normal range of every vital sign as (name, low, high, unit), keyed by ITEMID
+# The CareVue and MetaVision ITEMIDs of the same vital sign share a name, 40055 (urine output) has no range
+normal_ranges = {
+    211: ("Heart Rate", 60, 100, "bpm"),
+    220045: ("Heart Rate", 60, 100, "bpm"),
+    51: ("Systolic Blood Pressure", 90, 120, "mmHg"),
+    220179: ("Systolic Blood Pressure", 90, 120, "mmHg"),
+    8368: ("Diastolic Blood Pressure", 60, 80, "mmHg"),
+    220180: ("Diastolic Blood Pressure", 60, 80, "mmHg"),
+    52: ("Mean Blood Pressure", 70, 100, "mmHg"),
+    220181: ("Mean Blood Pressure", 70, 100, "mmHg"),
+    618: ("Respiratory Rate", 12, 20, "insp/min"),
+    220210: ("Respiratory Rate", 12, 20, "insp/min"),
+    646: ("SpO2", 95, 100, "%"),
+    220277: ("SpO2", 95, 100, "%"),
+    678: ("Temperature", 97.0, 99.0, "degF"),
+    223761: ("Temperature", 97.0, 99.0, "degF"),
+    113: ("Central Venous Pressure", 2, 8, "mmHg"),
+    220074: ("Central Venous Pressure", 2, 8, "mmHg"),
+    807: ("Glucose", 70, 140, "mg/dL"),
+    220621: ("Glucose", 70, 140, "mg/dL"),
+}
+
+# Spellings of VALUEUOM found in CHARTEVENTS and the unit they stand for
+unit_aliases = {"?f": "degF", "deg. f": "degF", "°f": "degF", "?c": "degC", "deg. c": "degC", "°c": "degC", "mmol/l": "mmol/L", "mg/dl": "mg/dL"}
+
+# Conversions of measured values to the unit of their normal range, as (from unit, to unit): (scale, offset)
+unit_conversions = {
+    ("degC", "degF"): (9 / 5, 32),
+    ("mmol/L", "mg/dL"): (18.016, 0),
+}